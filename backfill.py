@@ -0,0 +1,87 @@
+import json
+import time
+
+import discord
+
+from storage import JsonWriter
+
+
+# works through a channel's whole history for the owner's backfill commands, oldest post first. posts are
+# streamed from Discord a page at a time and folded into a running result as they arrive, so the channel
+# is never held in memory all at once. the result so far and the last post done are saved as a checkpoint
+# as it goes, so a run that stops partway (an error, a restart) carries on from there the next time
+class Backfill:
+    def __init__(self, file_path="backfill.json", save_delay=5, checkpoint_every=100, report_every=10):
+        self.checkpoint_every = checkpoint_every # posts folded in between checkpoints
+        self.report_every = report_every # seconds between progress reports
+
+        # "<job> <guild id>" -> {"channel_id", "last_id", "post_num", "state"} for runs that haven't finished
+        try:
+            with open(file_path) as f:
+                self.checkpoints = json.load(f)
+        except FileNotFoundError:
+            self.checkpoints = {}
+
+        self.writer = JsonWriter(self.checkpoints, file_path, save_delay)
+        self.running = set()
+
+    def resumable(self, job, guild_id):
+        return f"{job} {guild_id}" in self.checkpoints
+
+    # fold every finished post in `channel` into the state made by `new_state`, calling
+    # fold(state, post, post number) for each (and awaiting it, if it's a coroutine function). stops at the first post `is_open` says is still being voted
+    # on. `report(posts done, posts per second)` is awaited every so often to show progress. the state has
+    # to be plain JSON data so it can be checkpointed. returns (state, number of posts), or None if this
+    # job is already running for the server
+    async def run(self, job, channel, new_state, fold, is_open, report):
+        key = f"{job} {channel.guild.id}"
+        if key in self.running:
+            return None
+
+        checkpoint = self.checkpoints.get(key)
+        if checkpoint is None or checkpoint["channel_id"] != channel.id:
+            checkpoint = self.checkpoints[key] = {"channel_id": channel.id, "last_id": None, "post_num": 0, "state": new_state()}
+
+        after = discord.Object(checkpoint["last_id"]) if checkpoint["last_id"] is not None else None
+        state = checkpoint["state"]
+
+        self.running.add(key)
+        try:
+            started = last_report = time.monotonic()
+            done = 0
+
+            async for post in channel.history(limit=None, after=after, oldest_first=True):
+                if is_open(post):
+                    break
+
+                # nothing awaits between the state changing and the post being noted as done, so a
+                # checkpoint always matches the state saved with it. folds that await keep what they
+                # make somewhere else
+                post_num = checkpoint["post_num"] + 1
+                folded = fold(state, post, post_num)
+                if folded is not None:
+                    await folded
+                checkpoint["post_num"] = post_num
+                checkpoint["last_id"] = post.id
+                done += 1
+
+                if done % self.checkpoint_every == 0:
+                    self.writer.touch()
+
+                now = time.monotonic()
+                if now - last_report >= self.report_every:
+                    last_report = now
+                    await report(checkpoint["post_num"], done / (now - started))
+        except Exception:
+            # keep what's been done so far for next time
+            self.writer.touch()
+            raise
+        finally:
+            self.running.discard(key)
+
+        del self.checkpoints[key]
+        self.writer.touch()
+        return state, checkpoint["post_num"]
+
+    async def flush(self):
+        await self.writer.flush()
@@ -0,0 +1,334 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from fakes import FakeContext, FakeDiscord, new_snowflake
+from storage import PREFERENCE_CATEGORIES, SqliteStore
+
+# benchmarks the bot's busiest paths against the pretend Discord in fakes.py, so they can be measured
+# under load without a real connection. run from the repository:
+#
+#   python bench.py                          run everything with the default sizes
+#   python bench.py --save baseline.json     ...and save the results
+#   python bench.py --compare baseline.json  ...and compare them with saved results, failing on regressions
+#
+# see --help for the sizes, simulated latency and rate limits. everything runs in a temporary directory,
+# so none of the bot's real files are touched
+
+PATHS = ("handle_post", "reactions", "poll", "leaderboard", "graph")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the bot against a simulated Discord.")
+    parser.add_argument("--paths", nargs="+", choices=PATHS, default=list(PATHS), help="which paths to run")
+    parser.add_argument("--storage", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--guilds", type=int, default=4, help="servers to simulate")
+    parser.add_argument("--members", type=int, default=300, help="members in each server")
+    parser.add_argument("--history", type=int, default=2000, help="finished posts each server starts with")
+    parser.add_argument("--posts", type=int, default=2000, help="posts for handle_post and poll")
+    parser.add_argument("--open-posts", type=int, default=200, help="open posts the reaction storm is spread over")
+    parser.add_argument("--reactions", type=int, default=5000, help="reactions in the reaction storm")
+    parser.add_argument("--iterations", type=int, default=30, help="leaderboard calls (graph does a fifth as many)")
+    parser.add_argument("--latency", type=float, default=10, help="milliseconds each simulated API call takes")
+    parser.add_argument("--rate-limit", type=float, default=50, help="simulated API calls per second allowed on each route")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare the results with this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.2, help="how much worse (as a fraction) counts as a regression")
+    return parser.parse_args()
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100), len(values) - 1)] if values else 0.0
+
+
+class Bench:
+    def __init__(self, client, fake, args):
+        self.client = client
+        self.bot = client.bot
+        self.fake = fake
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.key = list(self.bot.default_key)
+        self.guilds = [fake.add_guild(args.members) for _ in range(args.guilds)]
+
+    def random_votes(self):
+        return {emoji: self.random.randrange(4) for emoji in self.key}
+
+    # give every server some finished posts to start from, with real (pretend) messages behind them so
+    # the records can be fetched
+    def seed_history(self):
+        for guild in self.guilds:
+            authors = list(guild.members.values())
+            for _ in range(self.args.history):
+                votes = self.random_votes()
+                message = guild.image_channel.add_post(self.random.choice(authors), votes)
+                score = sum(self.bot.default_key[emoji] * count for emoji, count in votes.items())
+                self.bot.store.record_post(guild.id, message.author.id, message.id, guild.image_channel.id, score, votes)
+
+    # wait for everything queued to go out to (pretend) Discord
+    async def drain(self):
+        outbound = self.bot.outbound
+        while outbound.in_flight or any(outbound.waiting_actions()):
+            await asyncio.sleep(0.01)
+
+    # run `body`, which returns a list of latencies in seconds, and sum it up
+    async def measure(self, body):
+        calls_before = sum(self.fake.calls.values())
+        routes_before = dict(self.fake.calls)
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        latencies = await body()
+        await self.drain()
+        seconds = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        operations = len(latencies)
+        calls = sum(self.fake.calls.values()) - calls_before
+        return {
+            "operations": operations,
+            "seconds": round(seconds, 4),
+            "throughput": round(operations / seconds, 2),
+            "p50_ms": round(1000 * percentile(latencies, 50), 3),
+            "p99_ms": round(1000 * percentile(latencies, 99), 3),
+            "api_calls_per_op": round(calls / operations, 3) if operations else 0.0,
+            "api_calls": {route: count - routes_before.get(route, 0) for route, count in self.fake.calls.items()
+                          if count > routes_before.get(route, 0)},
+            "peak_memory_kib": round(peak / 1024, 1),
+        }
+
+    # recording finished posts, one after another
+    async def handle_post(self):
+        latencies = []
+        for _ in range(self.args.posts):
+            guild = self.random.choice(self.guilds)
+            author = self.random.choice(list(guild.members.values()))
+            votes = self.random_votes()
+            score = sum(self.bot.default_key[emoji] * count for emoji, count in votes.items())
+            message_id = new_snowflake()
+
+            started = time.perf_counter()
+            self.bot.handle_post(guild.id, author.id, message_id, guild.image_channel.id, score, votes)
+            latencies.append(time.perf_counter() - started)
+
+        return latencies
+
+    # open posts and the messages behind them, spread over the servers
+    def open_posts(self, count, finish_time, tracked):
+        posts = []
+        for number in range(count):
+            guild = self.guilds[number % len(self.guilds)]
+            author = self.random.choice(list(guild.members.values()))
+            message = guild.image_channel.add_post(author, self.random_votes())
+
+            if tracked:
+                self.bot.live_posts[str(message.id)] = {"guild_id": guild.id, "author_id": author.id, "votes": {}, "voters": {}}
+            self.bot.schedule_post(str(message.id), guild.image_channel.id, finish_time, guild.id)
+            posts.append(message)
+
+        return posts
+
+    # a burst of votes on open posts, all at once. some are on the voter's own post or are a second
+    # vote, which the bot takes back
+    async def reactions(self):
+        posts = self.open_posts(self.args.open_posts, time.time() + 60*60, tracked=True)
+
+        async def react(message, user_id, emoji):
+            started = time.perf_counter()
+            await self.fake.dispatch_reaction("on_raw_reaction_add", message, user_id, emoji)
+            return time.perf_counter() - started
+
+        events = []
+        for _ in range(self.args.reactions):
+            message = self.random.choice(posts)
+            if self.random.random() < 0.05:
+                user_id = message.author.id
+            else:
+                user_id = self.random.choice(list(message.guild.members))
+            events.append(react(message, user_id, self.random.choice(self.key)))
+
+        latencies = await asyncio.gather(*events)
+
+        # close the posts again so they don't get in the way of the other paths
+        for message in posts:
+            self.bot.live_posts.pop(str(message.id), None)
+            self.bot.store.remove_open_post(str(message.id))
+
+        return latencies
+
+    # finishing a pile of posts that are all due. half have running tallies; the rest have to be fetched,
+    # as if the bot had just restarted. latency is from the poll loop starting to each post being recorded
+    async def poll(self):
+        count = self.args.posts // 2
+        self.open_posts(count, time.time() - 1, tracked=True)
+        self.open_posts(self.args.posts - count, time.time() - 1, tracked=False)
+
+        latencies = []
+        handle_post = self.bot.handle_post
+
+        def timed_handle_post(*args):
+            latencies.append(time.perf_counter() - started)
+            handle_post(*args)
+
+        self.bot.handle_post = timed_handle_post
+        started = time.perf_counter()
+        task = asyncio.ensure_future(self.bot.poll())
+        try:
+            while self.bot.current_images:
+                await asyncio.sleep(0.01)
+        finally:
+            task.cancel()
+            del self.bot.handle_post
+
+        # posts that couldn't be fetched are dropped without being recorded, which would make this look fast
+        if len(latencies) != self.args.posts:
+            raise RuntimeError(f"Only {len(latencies)} of {self.args.posts} finished posts were recorded")
+
+        return latencies
+
+    # run a command `count` times in random servers, timing each call
+    async def command(self, command, count, make_args, before=None):
+        latencies = []
+        for _ in range(count):
+            guild = self.random.choice(self.guilds)
+            ctx = FakeContext(self.bot, guild, self.random.choice(list(guild.members.values())))
+            if before is not None:
+                before(guild)
+
+            started = time.perf_counter()
+            await command.callback(ctx, *make_args())
+            latencies.append(time.perf_counter() - started)
+
+        return latencies
+
+    async def leaderboard(self):
+        pages = (self.args.members - 1) // self.bot.leaderboard_page_size + 1
+        return await self.command(self.client.leaderboard, self.args.iterations, lambda: (None, self.random.randint(1, pages)))
+
+    # every graph is drawn from scratch rather than coming from the chart cache
+    async def graph(self):
+        return await self.command(self.client.graph, max(self.args.iterations // 5, 1), lambda: (None,),
+                                  before=lambda guild: self.bot.bump_data_version(guild.id))
+
+    async def run(self):
+        self.fake.attach(self.bot)
+        self.seed_history()
+
+        # draw one chart first so starting the renderer's processes isn't counted
+        if "graph" in self.args.paths:
+            await self.command(self.client.graph, 1, lambda: (None,))
+
+        results = {}
+        for path in self.args.paths:
+            results[path] = await self.measure(getattr(self, path))
+
+        self.bot.renderer.shutdown()
+        return results
+
+
+def print_results(results):
+    print(f"{'path':<12} {'ops':>7} {'ops/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'calls/op':>9} {'peak KiB':>10}")
+    for path, result in results.items():
+        print(f"{path:<12} {result['operations']:>7} {result['throughput']:>10.1f} {result['p50_ms']:>9.3f} "
+              f"{result['p99_ms']:>9.3f} {result['api_calls_per_op']:>9.3f} {result['peak_memory_kib']:>10.1f}")
+
+
+# print how each result changed from the baseline and return the regressions
+def compare(results, baseline, threshold):
+    # metric -> True if bigger is better
+    metrics = {"throughput": True, "p50_ms": False, "p99_ms": False, "api_calls_per_op": False, "peak_memory_kib": False}
+    regressions = []
+
+    for path, result in results.items():
+        old = baseline["results"].get(path)
+        if old is None:
+            continue
+
+        changes = []
+        for metric, bigger_is_better in metrics.items():
+            if not old[metric]:
+                continue
+
+            change = (result[metric] - old[metric]) / old[metric]
+            changes.append(f"{metric} {change:+.0%}")
+            if (-change if bigger_is_better else change) > threshold:
+                regressions.append(f"{path} {metric}: {old[metric]} -> {result[metric]}")
+
+        print(f"{path:<12} " + ", ".join(changes))
+
+    return regressions
+
+
+def git_version():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    args = parse_args()
+    save_path = os.path.abspath(args.save) if args.save else None
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+
+    # the bot reads and writes its files in the working directory, so give it an empty one
+    os.chdir(tempfile.mkdtemp(prefix="james-bench-"))
+    for path in ("current_posts.json", "scores.json"):
+        with open(path, "w") as f:
+            json.dump({}, f)
+    with open("preferences.json", "w") as f:
+        json.dump({category: {} for category in PREFERENCE_CATEGORIES}, f)
+
+    # only now, so the bot loads its files from there
+    import client
+
+    bot = client.make_bot()
+    if args.storage == "sqlite":
+        bot.store = SqliteStore("james.db")
+        bot.current_images = bot.store.open_posts
+        bot.preferences = bot.store.preferences
+        bot.rebuild_routes()
+
+    fake = FakeDiscord(latency=args.latency / 1000, rate_limit=args.rate_limit, seed=args.seed)
+
+    # the bot prints a line for every post it finishes, which would drown out the results
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results = bot.loop.run_until_complete(Bench(client, fake, args).run())
+
+        # stop the bot's background tasks (like the file writers) before the loop goes away
+        tasks = asyncio.all_tasks(bot.loop)
+        for task in tasks:
+            task.cancel()
+        bot.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+    print_results(results)
+
+    if save_path:
+        with open(save_path, "w") as f:
+            json.dump({"version": git_version(), "config": vars(args), "results": results}, f, indent=2)
+
+    if compare_path:
+        with open(compare_path) as f:
+            baseline = json.load(f)
+
+        print(f"\nCompared with {baseline.get('version') or compare_path}:")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("\nRegressions:\n" + "\n".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import asyncio
+import io
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# everything here up to ChartRenderer runs in the worker processes. it only takes plain data (no Discord
+# objects) and builds its own figure each time, so nothing is shared between charts being drawn at once.
+# matplotlib is imported by the render functions themselves, so only the workers ever load it, and only
+# once they're first asked to draw something
+
+
+# colour the frame, ticks and axis labels white, which looks better in dark mode
+def whiten(ax):
+    for spine in ax.spines.values():
+        spine.set_color('white')
+
+    ax.tick_params(axis='x', colors='white')
+    ax.tick_params(axis='y', colors='white')
+    ax.xaxis.label.set_color('white')
+    ax.yaxis.label.set_color('white')
+
+
+def to_png(fig, transparent):
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', transparent=transparent)
+    return buffer.getvalue()
+
+
+# bar chart of how many posts got each score
+def render_distribution(image_scores, score_freqs, title):
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(8, 6))
+    ax = fig.subplots()
+
+    ax.bar(image_scores, score_freqs, color='white')
+    ax.tick_params(axis='x', labelrotation=90)
+    ax.set_ylabel('Frequency', color='white')
+    ax.set_title(title, color='white')
+    whiten(ax)
+
+    return to_png(fig, transparent=True)
+
+
+# users' scores over time. lines is a list of (label, colour, post numbers, running totals), one per user,
+# drawn as steps so each only needs a point where its user posted
+def render_graph(lines, transparent):
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(12, 8))
+    ax = fig.subplots()
+
+    for label, colour, post_nums, totals in lines:
+        ax.step(post_nums, totals, where='post', label=label, color=colour)
+
+    legend = ax.legend(framealpha=0)
+
+    if transparent:
+        for text in legend.get_texts():
+            text.set_color("white")
+
+        ax.set_xlabel('Total Submissions', color='white')
+        ax.set_title('Graph of user scores over time', color='white')
+        ax.set_ylabel('User scores', color='white')
+        whiten(ax)
+    else:
+        ax.set_xlabel('Total Submissions')
+        ax.set_title('Graph of user scores over time')
+        ax.set_ylabel('User scores')
+
+    return to_png(fig, transparent=transparent)
+
+
+class RendererBusy(Exception):
+    pass
+
+
+# draws charts in a pool of worker processes so rendering never holds up the event loop (and with it the
+# gateway heartbeat). only so many charts can be waiting at once; past that, render() raises RendererBusy
+# straight away rather than letting requests pile up
+class ChartRenderer:
+    def __init__(self, workers=2, queue_limit=8):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.pending = 0
+        self.pool = self.new_pool()
+
+    # workers are forked from a fork server rather than from the bot, which by then has threads (and
+    # their locks) that a forked copy would inherit halfway through whatever they were doing. where
+    # there's no fork server (Windows), they're started from scratch
+    def new_pool(self):
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(method))
+
+    # run one of the render functions above in a worker and return the PNG it made
+    async def render(self, function, *args):
+        if self.pending >= self.queue_limit:
+            raise RendererBusy()
+
+        self.pending += 1
+        try:
+            png = await asyncio.get_event_loop().run_in_executor(self.pool, function, *args)
+        except BrokenProcessPool:
+            # a worker died (e.g. ran out of memory), so start again with a fresh pool
+            self.pool = self.new_pool()
+            raise
+        finally:
+            self.pending -= 1
+
+        return png
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
+
+
+# remembers recently drawn charts. keys should include everything the chart depends on, including a version
+# number for the data that changes whenever the data does, so a cached chart is never out of date. if a
+# chart is asked for again while it's still being drawn, the second request waits for the first drawing
+# rather than starting another one
+class RenderCache:
+    def __init__(self, max_bytes=32*1024*1024):
+        self.max_bytes = max_bytes # least recently used charts are forgotten past this much PNG data
+        self.size = 0
+        self.entries = OrderedDict() # key -> PNG bytes
+        self.in_flight = {} # key -> task drawing that chart
+
+    # the chart for `key` as a file-like object ready for discord.File, drawing it with `make` (a coroutine
+    # function returning PNG bytes, or None if there's nothing to draw) if it isn't cached. returns None
+    # if there was nothing to draw
+    async def get(self, key, make):
+        png = self.entries.get(key)
+        if png is not None:
+            self.entries.move_to_end(key)
+            return io.BytesIO(png)
+
+        task = self.in_flight.get(key)
+        if task is None:
+            task = self.in_flight[key] = asyncio.ensure_future(make())
+            task.add_done_callback(lambda task: self.finish(key, task))
+
+        # shield the drawing so one waiter being cancelled doesn't cancel it for the rest
+        png = await asyncio.shield(task)
+        return io.BytesIO(png) if png is not None else None
+
+    def finish(self, key, task):
+        self.in_flight.pop(key, None)
+        if task.cancelled() or task.exception() is not None or task.result() is None:
+            return
+
+        png = task.result()
+        self.entries[key] = png
+        self.size += len(png)
+
+        while self.size > self.max_bytes and self.entries:
+            _, old_png = self.entries.popitem(last=False)
+            self.size -= len(old_png)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
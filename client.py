@@ -1,22 +1,34 @@
+import time
+started = time.perf_counter() # for the startup timings printed once the bot is ready
+
 from discord.ext import commands
-import numpy as np
-import matplotlib.pyplot as plt
 import discord
-import json
-import aiofiles
-import time
 import asyncio
-from collections import defaultdict
+import heapq
+import os
 import sys
-
-# get token from text file
-with open('token.txt') as f:
-    TOKEN = f.read()
-
-
-class VoteClient(commands.Bot):
-    def __init__(self, command_prefix):
-        super().__init__(command_prefix=command_prefix)
+import tempfile
+import traceback
+import typing
+from datetime import datetime, timezone
+
+from backfill import Backfill
+from charts import ChartRenderer, RenderCache, RendererBusy, render_distribution, render_graph
+from export import FORMATS, export_guild
+from members import MemberCache
+from metrics import registry
+from outbound import CLEANUP, PRIORITY_NAMES, REPLY, SEED, ActionQueue, QueuedContext
+from storage import JsonStore, SqliteStore, new_records, snowflake_time
+
+
+# sharded so the bot can be split across processes; see where the bot is made below
+class VoteClient(commands.AutoShardedBot):
+    def __init__(self, command_prefix, shard_ids=None, shard_count=None):
+        # how long each stage of starting up took, in seconds
+        self.startup_times = {"imports": time.perf_counter() - started}
+        stage_started = time.perf_counter()
+
+        super().__init__(command_prefix=command_prefix, shard_ids=shard_ids, shard_count=shard_count)
         self.default_key = {
             '😍': 2,
             '👍': 1,
@@ -25,31 +37,166 @@ class VoteClient(commands.Bot):
         }
         self.default_prefix = 'j!'
         self.default_timer = 24 # by default users have 24 hours to vote on a post
-        self.poll_rate = 30 # check for finished posts every 30 seconds
+        self.poll_rate = 30 # never sleep longer than 30 seconds between checks for finished posts
+        self.finalize_limit = 5 # how many finished posts can be fetched from Discord at once
+        self.outbound_limit = 4 # how many queued requests (replies, reactions) can be sent to Discord at once
+        self.render_workers = 2 # processes drawing charts
+        self.render_queue_limit = 8 # charts that can be waiting to be drawn before new requests are turned away
+        self.leaderboard_page_size = 20 # users shown on each page of the leaderboard
+        self.graph_points = 1000 # most points drawn for each user's line on a graph, about one per pixel across it
+        self.save_delay = 5 # wait 5 seconds for changes to settle before writing a file
+        self.storage = "json" # "json" keeps everything in JSON files, "sqlite" uses the database below
+        self.database_path = "james.db"
+        self.shard_idle_time = 30*60 # servers' scores are dropped from memory after 30 minutes without being used
+        self.repost_distance = 6 # how many bits (out of 64) an image's hash can differ from an earlier post's and still count as a repost, or None to not check
+        self.metrics_port = 9108 # local port Prometheus can scrape metrics from (plus the first shard number if sharded), or None
         self.owner_id = 169891281139531776 # owner's discord ID
         self.icon_url = 'https://cdn.discordapp.com/app-icons/232922698441949185/1d0f69cf7e1eced9f8d7b7a9aad86037.png'
         self.invite_url = 'https://discord.com/api/oauth2/authorize?client_id=513757460134232069&permissions=126016&scope=bot'
         self.competition = None
 
-        # load the scores, the current posts, and the bot preferences
-        with open('preferences.json') as preferences, open('scores.json') as scores, \
-             open('current_posts.json') as current_posts:
-            self.image_scores   = json.load(scores)
-            self.current_images = json.load(current_posts)
-            self.preferences   = json.load(preferences)
-            # self.hashes        = json.load(hashes)
+        # the shards this process runs, out of how many in total. None means this process runs them all
+        self.owned_shards = shard_ids
+        self.total_shards = shard_count
+
+        self.startup_times["client"] = time.perf_counter() - stage_started
+        stage_started = time.perf_counter()
 
-            # UPDATED JSON FORMAT: image_scores[str(message.guild.id)]["leaderboard" or "graph" or "submitted" or "records"]
-            # ["leaderboard"][str(message.author.id)]["score" or "submitted"]
-            # ["graph"][str(message.author.id)] is a list of tuples (individual image score, image # (for the server))
-            # ["submitted"] is the # images submitted to the server
-            # ["records"]["best or words"] - each is a triple (message id, channel id, score)
+        # load the current posts and the bot preferences. servers' scores are loaded as they're needed.
+        # processes running different shards have to share the database
+        if self.storage == "sqlite" or self.owned_shards is not None:
+            self.store = SqliteStore(self.database_path)
+        else:
+            self.store = JsonStore(save_delay=self.save_delay)
+
+        self.current_images = self.store.open_posts
+        self.backfill = Backfill(save_delay=self.save_delay) # checkpoints for the owner's history backfills
+        self.preferences = self.store.preferences
+
+        self.startup_times["storage"] = time.perf_counter() - stage_started
+        stage_started = time.perf_counter()
+
+        # min-heap of (finish time, message id) so the poll loop only has to look at posts that are due.
+        # entries are never removed early, so one is stale if its post is no longer in current_images
+        self.expiry_queue = []
+        self.load_expiry_queue()
+        self.new_post = asyncio.Event() # wakes the poll loop when a post is scheduled
+        self.finalize_slots = asyncio.Semaphore(self.finalize_limit)
+        self.poll_task = None
+        self.evict_task = None
+
+        # running vote tallies for open posts, kept up to date from reaction events so posts can be scored
+        # and votes checked without fetching anything. message id -> {"guild_id", "author_id",
+        # "votes": {emoji: number of votes}, "voters": {user id: set of emojis they reacted with}}.
+        # these only live in memory, so posts that were open before a restart are fetched when needed
+        self.live_posts = {}
+        self.live_post_fetches = {} # message id -> task fetching that post, so it's only fetched once
+        # message id -> changes to make to a post's tally once its fetch finishes, for reactions that
+        # happen while it's being fetched. each is a function taking the live post
+        self.pending_reactions = {}
+        # posts being finished by the poll loop. they're still open until they're recorded, but their
+        # tallies are done with, so nothing should fetch them again
+        self.closing = set()
+
+        self.outbound = ActionQueue(self.outbound_limit)
+        self.metrics = registry
+        self.metrics_task = None
+        self.metrics.set("james_open_posts", lambda: len(self.current_images))
+        for name in PRIORITY_NAMES.values():
+            self.metrics.set("james_outbound_waiting", lambda name=name: self.outbound.stats()[name][0], priority=name)
+
+        # count and time every request to Discord's REST API, by route
+        request = self.http.request
+        async def measured_request(route, **kwargs):
+            self.metrics.count("james_rest_requests_total", method=route.method, route=route.path)
+            with self.metrics.timer("james_rest_seconds", method=route.method, route=route.path):
+                return await request(route, **kwargs)
+        self.http.request = measured_request
+
+        # which messages are worth looking at: the image channels' IDs, and each server's prefix by server
+        # ID. built from the preferences by rebuild_routes(), which has to be called whenever they change
+        self.image_channels = set()
+        self.prefixes = {}
+        self.rebuild_routes()
+
+        self.members = MemberCache()
+        self.reposts = None # RepostFinder, made the first time an image is posted
+        self.renderer = ChartRenderer(self.render_workers, self.render_queue_limit)
+        self.renderer_busy_message = "I'm drawing a lot of charts right now. Please try again in a moment."
+        self.charts = RenderCache()
+        self.data_versions = {} # server id -> number bumped whenever its scores change, so cached charts can tell they're stale
+
+        self.startup_times["expiry queue and helpers"] = time.perf_counter() - stage_started
+        self.init_finished = time.perf_counter()
+
+    # (re)build the routing table from the preferences
+    def rebuild_routes(self):
+        self.image_channels = set(self.preferences["image_channels"].values())
+        self.prefixes = {int(guild_id_str): prefix for guild_id_str, prefix in self.preferences["prefixes"].items()}
+
+    # rebuild the expiry queue from the open posts, e.g. after loading them from disk
+    def load_expiry_queue(self):
+        self.expiry_queue[:] = [(post[1], message_id) for message_id, post in self.current_images.items()]
+        heapq.heapify(self.expiry_queue)
 
     # output startup message and begin checking for finished timers
     async def on_ready(self):
         print(f'Logged in successfully as {self.user.name} (ID: {self.user.id})')
         print('------')
-        await self.poll()
+
+        # on_ready fires again after every reconnect, so make sure only one poll loop is ever running
+        if self.poll_task is None:
+            self.start_task("poll_task", self.poll)
+            self.start_task("evict_task", self.evict_idle)
+            self.start_task("metrics_task", self.metrics.probe_loop_lag)
+
+            if self.metrics_port is not None:
+                port = self.metrics_port + (self.owned_shards[0] if self.owned_shards else 0)
+                try:
+                    await self.metrics.serve("127.0.0.1", port)
+                except OSError as error:
+                    print(f"Couldn't serve metrics on port {port}: {error}")
+
+            self.startup_times["connecting"] = time.perf_counter() - self.init_finished
+            print("Startup took " + ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in self.startup_times.items()) +
+                  f" ({time.perf_counter() - started:.2f}s in total)")
+
+    # run one of the bot's background loops as self.<name>. nothing waits on these, so if one dies its
+    # error is printed and it's started again after a few seconds rather than stopping for good
+    def start_task(self, name, make):
+        def done(task):
+            if task.cancelled():
+                return
+
+            error = task.exception()
+            print(f"{name} stopped unexpectedly. Restarting it...")
+            traceback.print_exception(type(error), error, error.__traceback__)
+            asyncio.get_event_loop().call_later(5, self.start_task, name, make)
+
+        task = asyncio.ensure_future(make())
+        task.add_done_callback(done)
+        setattr(self, name, task)
+
+    # every so often, drop servers nobody has used for a while from memory
+    async def evict_idle(self):
+        while True:
+            await asyncio.sleep(self.shard_idle_time / 2)
+            await self.store.evict_idle(self.shard_idle_time)
+            if self.reposts is not None:
+                self.reposts.evict_idle(self.shard_idle_time)
+
+    # commands reply through the outbound queue
+    async def get_context(self, message, *, cls=QueuedContext):
+        return await super().get_context(message, cls=cls)
+
+    # time every command and event handler
+    async def invoke(self, ctx):
+        with self.metrics.timer("james_command_seconds", command=ctx.command.qualified_name if ctx.command else "none"):
+            await super().invoke(ctx)
+
+    async def _run_event(self, coro, event_name, *args, **kwargs):
+        with self.metrics.timer("james_event_seconds", event=event_name):
+            await super()._run_event(coro, event_name, *args, **kwargs)
 
     # process commands, or check if the message is a post to be voted on
     async def on_message(self, message):
@@ -62,30 +209,27 @@ class VoteClient(commands.Bot):
             await message.channel.send("unlucky")
             return
 
+        # most messages are neither commands nor posts, so drop those before the commands framework sees them
+        is_post = message.channel.id in self.image_channels
+        if not is_post and not message.content.startswith(self.prefixes.get(message.guild.id, self.default_prefix)):
+            return
+
         # process commands
         await self.process_commands(message)
 
-        # if the image channel has not been set, this will return None so the following
-        # if statement will never run
-        image_channel = self.preferences["image_channels"].get(str(message.guild.id))
-
-        if message.channel.id == image_channel:
+        if is_post:
             # check if the message has an image attached
             if message.attachments:
-                # hashing stuff, not yet implemented
-                # get the image and hash it
-
-                # url = message.attachments[0].url
-                # response = requests.get(url, stream=True)
-                # img = Image.open(io.BytesIO(response.content))
-                # hash = imagehash.phash(img)
+                # start counting votes before the reactions go on, so none are missed
+                self.live_posts[str(message.id)] = {"guild_id": message.guild.id, "author_id": message.author.id, "votes": {}, "voters": {}}
 
-                # get the server's voting emojis and add them to the message
+                # get the server's voting emojis and add them to the message, then add the clock emoji to
+                # show voting is open. these are queued behind any replies, and go on in this order
                 key = self.get_key(message.guild)
 
-                for emoji in key.keys():
-                    await message.add_reaction(emoji)
-                await message.add_reaction('🕒') # add clock emoji to show voting is open
+                for emoji in [*key.keys(), '🕒']:
+                    self.outbound.post(SEED, ("reactions", message.channel.id), lambda emoji=emoji: message.add_reaction(emoji),
+                                       key=("add", message.id, emoji), tag=message.id, description=f"adding {emoji} to post {message.id}")
 
                 # add this to the list of posts currently being vote on
                 try:
@@ -94,147 +238,414 @@ class VoteClient(commands.Bot):
                     timer = self.default_timer
 
                 # add this post ID, its channel ID and its expiry time to the current images dictionary
-                self.current_images[str(message.id)] = [message.channel.id, time.time() + 60*60*timer]
-                await self.save(self.current_images, "current_posts.json")
+                self.schedule_post(str(message.id), message.channel.id, time.time() + 60*60*timer, message.guild.id)
+
+                # download and hash the image in the background so voting isn't held up
+                if self.repost_distance is not None:
+                    asyncio.ensure_future(self.check_repost(message))
+
+    # the repost finder, made when it's first needed so numpy and PIL aren't imported at startup
+    def repost_finder(self):
+        if self.reposts is None:
+            from reposts import RepostFinder
+            self.reposts = RepostFinder()
+        return self.reposts
+
+    # point out posts whose image looks like one already posted in the server
+    async def check_repost(self, message):
+        result = await self.repost_finder().check(message, self.repost_distance)
+        if result is None or result[1] is None:
+            return
+
+        _, message_id, channel_id = result[1]
+        link = f"https://discord.com/channels/{message.guild.id}/{channel_id}/{message_id}"
+        self.outbound.post(REPLY, ("messages", message.channel.id),
+                           lambda: message.channel.send(f"{message.author.mention} this looks like a repost of {link}"),
+                           tag=message.id, description=f"pointing out repost {message.id}")
+
+    # start the voting timer on a post and wake the poll loop in case it is now the next one due
+    def schedule_post(self, message_id, channel_id, finish_time, guild_id):
+        self.store.add_open_post(message_id, channel_id, finish_time, guild_id)
+        heapq.heappush(self.expiry_queue, (finish_time, message_id))
+        self.new_post.set()
+
+    # try finishing a post again later, after something went wrong finishing it
+    def retry_post(self, message_id, error):
+        print(f"Couldn't finish post {message_id}. Trying again in {self.poll_rate}s...")
+        traceback.print_exception(type(error), error, error.__traceback__)
+        heapq.heappush(self.expiry_queue, (time.time() + self.poll_rate, message_id))
 
     # check for finished posts
     async def poll(self):
         while True:
-            # get the current time and prepare and empty list to fill with posts that have finished
-            # this is necessary since popping dictionary elements during the below loop would cause a crash
+            # pop every post whose deadline has passed off the front of the queue. this only
+            # touches the posts that have finished, however many are still open
             current_time = time.time()
             finished_posts = []
+            finishing = set()
+
+            while self.expiry_queue and self.expiry_queue[0][0] <= current_time:
+                finish_time, message_id = heapq.heappop(self.expiry_queue)
+                post = self.current_images.get(message_id)
+
+                # skip stale entries for posts that have already been handled or rescheduled (retries
+                # are due after the post's finish time, anything earlier is out of date), and posts
+                # in servers another process is running
+                if post is None or post[1] > finish_time or message_id in finishing or not self.owns_post(post):
+                    continue
+
+                finished_posts.append((post[0], message_id))
+                finishing.add(message_id)
+
+            self.closing |= finishing
+            try:
+                await self.finish_posts(finished_posts)
+            except Exception as error:
+                # the posts that weren't recorded are still open, so they're tried again
+                for _, message_id in finished_posts:
+                    if message_id in self.current_images:
+                        self.retry_post(message_id, error)
+            finally:
+                self.closing -= finishing
+
+            # sleep until the next post is due, or until on_message schedules a new one. the event
+            # is cleared before the deadline is read so a post added meanwhile can't be missed
+            self.new_post.clear()
+            timeout = self.poll_rate
+            if self.expiry_queue:
+                timeout = min(timeout, self.expiry_queue[0][0] - time.time())
+
+            try:
+                await asyncio.wait_for(self.new_post.wait(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    # fetch and score finished posts concurrently, but only a few at a time so we stay inside
+    # Discord's rate limits. the results are then applied one by one in deadline order so every post
+    # gets the same post number however the fetches happen to finish. a post that can't be scored or
+    # recorded is tried again later
+    async def finish_posts(self, finished_posts):
+        if not finished_posts:
+            return
 
-            # check which posts have finished and add them to the list
-            for message_id, (channel_id, finish_time) in self.current_images.items():
-                if finish_time < current_time:
-                    finished_posts.append((channel_id, message_id))
+        self.metrics.set("james_finalize_backlog", len(finished_posts))
+        try:
+            with self.metrics.timer("james_finalize_seconds"):
+                results = await asyncio.gather(*(self.score_post(channel_id, message_id) for channel_id, message_id in finished_posts),
+                                               return_exceptions=True)
+
+                for (_, message_id), result in zip(finished_posts, results):
+                    if isinstance(result, Exception):
+                        self.retry_post(message_id, result)
+                        continue
+
+                    # only record posts that were still open, in case another process sharing the database
+                    # finished one first (e.g. while shards were being moved between processes)
+                    post = self.current_images.get(message_id)
+                    try:
+                        if self.close_post(message_id) and result is not None:
+                            self.handle_post(*result)
+                    except Exception as error:
+                        # put the post back if it was taken out before recording it failed
+                        if post is not None and result is not None and message_id not in self.current_images:
+                            self.store.add_open_post(message_id, post[0], post[1], result[0])
+                        self.retry_post(message_id, error)
+        finally:
+            self.metrics.set("james_finalize_backlog", 0)
+
+    # whether this process runs the shard the server is on
+    def owns_guild(self, guild_id):
+        return self.owned_shards is None or (guild_id >> 22) % self.total_shards in self.owned_shards
+
+    # the same for an open post. posts saved before their server was recorded belong to whichever
+    # process can see their channel
+    def owns_post(self, post):
+        if self.owned_shards is None:
+            return True
 
-            # now loop through these posts and handle them
-            for channel_id, message_id in finished_posts:
-                await self.handle_post(channel_id, message_id)
-                self.current_images.pop(message_id)
+        if len(post) > 2:
+            return self.owns_guild(post[2])
 
-            # update the JSON of current posts, in case of a restart
-            await self.save(self.current_images, "current_posts.json")
-            await self.save(self.image_scores, "new_posts.json")
+        return self.get_channel(post[0]) is not None
 
-            # wait then repeat
-            await asyncio.sleep(self.poll_rate)
+    # close voting on a post that has run out of time and calculate its score. the running tally is
+    # used if there is one, otherwise the post is fetched. returns None if the post can't be found
+    async def score_post(self, channel_id, message_id):
+        live_post = self.live_posts.pop(message_id, None)
+        if live_post is None:
+            async with self.finalize_slots:
+                live_post = await self.fetch_live_post(channel_id, message_id, with_voters=False)
 
-    # the procedure to follow for posts that have run out of voting time
-    async def handle_post(self, channel_id, message_id):
+            if live_post is None:
+                return None
+
+            # fetch_live_post starts tracking the post again, but voting is over
+            self.live_posts.pop(message_id, None)
+
+        # remove the clock emoji to show voting time is over. nothing here depends on it, so it's just queued
+        self.remove_clock(channel_id, message_id)
+
+        # calculate the post's score, and keep the votes themselves in case the key changes later
+        score = self.tally_score(live_post)
+        votes = {emoji: count for emoji, count in live_post["votes"].items() if count > 0}
+
+        return live_post["guild_id"], live_post["author_id"], int(message_id), channel_id, score, votes
+
+    # fetch an open post and rebuild its running tally from its reactions. paging through who voted
+    # costs an API request per emoji, so that can be skipped when the post is about to close.
+    # returns None if the post can't be found
+    async def fetch_live_post(self, channel_id, message_id, with_voters=True):
         try:
             image_channel = self.get_channel(channel_id)
             message = await image_channel.fetch_message(message_id)
         except:
             print(f"Either post deleted or channel unavailable (message ID {message_id}). Continuing...")
-            return
+            return None
+
+        votes = self.message_votes(message)
+
+        # reactions can change while this pages through them, so the counts are taken from who voted,
+        # to match it
+        voters = {}
+        if with_voters:
+            votes = {}
+            for react in message.reactions:
+                emoji = str(react.emoji)
+                votes[emoji] = 0
+                async for reacter in react.users():
+                    if reacter.id != self.user.id:
+                        voters.setdefault(reacter.id, set()).add(emoji)
+                        votes[emoji] += 1
+
+        live_post = {"guild_id": message.guild.id, "author_id": message.author.id, "votes": votes, "voters": voters}
+        self.live_posts[str(message_id)] = live_post
+
+        return live_post
+
+    # the running tally for an open post, fetching the post if there isn't one (e.g. after a restart).
+    # everyone who asks while the fetch is running waits for the same one. `change` is a change to make
+    # to the tally (see pending_reactions), made once the post is fetched. returns None for posts that
+    # aren't open for voting any more
+    async def get_live_post(self, message_id, change=None):
+        if message_id not in self.current_images or message_id in self.closing:
+            return None
 
-        # remove the clock emoji to show voting time is over
-        await message.remove_reaction(emoji='🕒', member=self.user)
+        live_post = self.live_posts.get(message_id)
+        if live_post is not None:
+            if change is not None:
+                change(live_post)
+            return live_post
+
+        fetch = self.live_post_fetches.get(message_id)
+        if fetch is None:
+            channel_id = self.current_images[message_id][0]
+            self.pending_reactions[message_id] = []
+            fetch = self.live_post_fetches[message_id] = asyncio.ensure_future(self.load_live_post(channel_id, message_id))
+            fetch.add_done_callback(lambda _: self.live_post_fetches.pop(message_id, None))
+
+        if change is not None and message_id in self.pending_reactions:
+            self.pending_reactions[message_id].append(change)
+        return await asyncio.shield(fetch)
+
+    # fetch a post and catch its tally up with the reactions that happened meanwhile. the fetch may or
+    # may not have seen them, so each change only makes sure the reaction is or isn't there
+    async def load_live_post(self, channel_id, message_id):
+        try:
+            live_post = await self.fetch_live_post(channel_id, message_id)
+        finally:
+            changes = self.pending_reactions.pop(message_id, [])
 
-        # calculate the post's score
-        key = self.get_key(message.guild)
-        score = sum(key.get(react.emoji, 0) * (react.count-1) for react in message.reactions)
+        # voting may have closed while the post was being fetched, and then it's no use
+        if message_id not in self.current_images or message_id in self.closing:
+            self.live_posts.pop(message_id, None)
+            return None
 
-        # all keys must be strings because we're saving to JSON
-        guild_id_str, author_id_str = str(message.guild.id), str(message.author.id)
+        if live_post is not None:
+            for change in changes:
+                change(live_post)
+        return live_post
+
+    # stop voting on a post: it's no longer open and its tally is forgotten. returns whether the post
+    # was still open (see the stores' remove_open_post)
+    def close_post(self, message_id):
+        self.live_posts.pop(message_id, None)
+        self.pending_reactions.pop(message_id, None)
+        return self.store.remove_open_post(message_id)
+
+    # count or uncount a user's reaction. does nothing if it's already counted (or not), so it's safe
+    # to repeat one the tally already has
+    @staticmethod
+    def set_reaction(live_post, user_id, emoji, reacted):
+        voted = live_post["voters"].setdefault(user_id, set())
+        if (emoji in voted) != reacted:
+            votes = live_post["votes"]
+            if reacted:
+                voted.add(emoji)
+                votes[emoji] = votes.get(emoji, 0) + 1
+            else:
+                voted.discard(emoji)
+                votes[emoji] = max(votes.get(emoji, 0) - 1, 0)
+
+        if not voted:
+            live_post["voters"].pop(user_id)
+
+    # a post's score under its server's current key
+    def tally_score(self, live_post):
+        return self.score_votes(live_post["guild_id"], live_post["votes"])
+
+    # the score for {emoji: number of votes} under a server's current key. everything that scores posts
+    # goes through here, so scores always agree with rescoring the votes they were saved with
+    def score_votes(self, guild_id, votes):
+        key = self.get_key(discord.Object(guild_id))
+        return sum(key.get(emoji, 0) * count for emoji, count in votes.items())
+
+    # a fetched post's votes, {emoji: number of votes}. the bot's own reactions don't count
+    @staticmethod
+    def message_votes(message):
+        return {str(react.emoji): react.count - react.me for react in message.reactions if react.count > react.me}
+
+    def remove_clock(self, channel_id, message_id):
+        self.queue_unreaction(channel_id, int(message_id), '🕒', self.user.id)
+
+    # queue taking back a reaction. a queued removal is dropped if the reaction goes before it's sent
+    def queue_unreaction(self, channel_id, message_id, emoji, user_id):
+        channel = self.get_channel(channel_id)
+        if channel is None:
+            print(f"Couldn't remove {emoji} from post {message_id}. Continuing...")
+            return
 
-        # check if the server exists in the scores dictionary
-        if not self.image_scores.get(guild_id_str, False):
-            print(f"First post on server {message.guild.name}! ({message.guild.id})")
-            self.image_scores[guild_id_str] = {"leaderboard": {}, "graph": {}, "submitted": 0, "records": {"best": (0, 0, -1), "worst": (0, 0, 100000)}}
+        post = channel.get_partial_message(message_id)
+        self.outbound.post(CLEANUP, ("reactions", channel_id), lambda: post.remove_reaction(emoji, discord.Object(user_id)),
+                           key=("remove", message_id, emoji, user_id), tag=message_id, description=f"removing {emoji} from post {message_id}")
 
-        # check if the user has submitted a post before
-        if not self.image_scores[guild_id_str]["leaderboard"].get(author_id_str, False):
-            print(f"First post on server {message.guild.name} from user {message.author.id}")
-            self.image_scores[guild_id_str]["leaderboard"][author_id_str] = {"score": 0, "submitted": 0}
-            self.image_scores[guild_id_str]["graph"][author_id_str] = []
+    def data_version(self, guild_id):
+        return self.data_versions.get(guild_id, 0)
 
+    def bump_data_version(self, guild_id):
+        self.data_versions[guild_id] = self.data_version(guild_id) + 1
 
-        # check if the post is the best or worst so far
-        worst_score = self.image_scores[guild_id_str]["records"]["worst"][2]
-        best_score = self.image_scores[guild_id_str]["records"]["best"][2]
+    # the procedure to follow for posts that have run out of voting time
+    def handle_post(self, guild_id, author_id, message_id, channel_id, score, votes):
+        post_num = self.store.record_post(guild_id, author_id, message_id, channel_id, score, votes)
+        self.bump_data_version(guild_id)
+        self.metrics.count("james_posts_finished_total")
 
-        if score < worst_score:
-            self.image_scores[guild_id_str]["records"]["worst"] = (message.id, message.channel.id, score)
+        guild = self.get_guild(guild_id)
+        guild_name = guild.name if guild is not None else guild_id
 
-        if score > best_score:
-            self.image_scores[guild_id_str]["records"]["best"] = (message.id, message.channel.id, score)
+        if post_num == 1:
+            print(f"First post on server {guild_name}! ({guild_id})")
 
-        # calculate the user's new overall score
-        user_updated_total = self.image_scores[guild_id_str]["leaderboard"][author_id_str]["score"] + score
+        # print an update
+        print(f"Post from {author_id} in {guild_name} successfully processed with a score of {score}")
 
-        # find what post number this is for the server
-        post_num = self.image_scores[guild_id_str]["submitted"] + 1
+    # keep the running tallies up to date, and stop users voting on their own post or voting more than
+    # once. these fire for every reaction, cached message or not
+    async def on_raw_reaction_add(self, payload):
+        message_id = str(payload.message_id)
+        if payload.user_id == self.user.id:
+            return
 
-        # update the leaderboard info
-        self.image_scores[guild_id_str]["leaderboard"][author_id_str]["score"] = user_updated_total
-        self.image_scores[guild_id_str]["leaderboard"][author_id_str]["submitted"] += 1
+        emoji = str(payload.emoji)
+        live_post = self.live_posts.get(message_id)
 
-        # update the graph-drawing info
-        self.image_scores[guild_id_str]["graph"][author_id_str].append((score, post_num))
+        if live_post is None:
+            if message_id not in self.current_images:
+                return
 
-        # incremement the server's post count
-        self.image_scores[guild_id_str]["submitted"] += 1
+            # the post has been open since before a restart, so it's fetched, then this reaction is counted
+            live_post = await self.get_live_post(message_id, lambda live_post: self.set_reaction(live_post, payload.user_id, emoji, True))
+            if live_post is None:
+                return
+        else:
+            self.set_reaction(live_post, payload.user_id, emoji, True)
 
-        # print an update
-        print(f"Post from {message.author.name} in {message.guild.name} successfully processed with a score of {score}")
+        if payload.user_id == live_post["author_id"] or len(live_post["voters"].get(payload.user_id, ())) > 1:
+            self.remove_vote(payload)
 
-    # prevent users from voting on their own post, or from voting multiple times
-    async def on_reaction_add(self, user_reaction, user):
-        if user == self.user:
+    async def on_raw_reaction_remove(self, payload):
+        # if we were about to take this reaction back, there's no need any more
+        self.outbound.cancel(("remove", payload.message_id, str(payload.emoji), payload.user_id))
+
+        if payload.user_id == self.user.id:
             return
 
-        message = user_reaction.message
+        self.change_live_post(str(payload.message_id), lambda live_post: self.set_reaction(live_post, payload.user_id, str(payload.emoji), False))
 
-        if message.channel.id == self.preferences["image_channels"].get(str(message.guild.id)):
-            if user == message.author:
-                await message.remove_reaction(user_reaction, user)
+    async def on_raw_reaction_clear(self, payload):
+        def clear(live_post):
+            live_post["votes"].clear()
+            live_post["voters"].clear()
 
-            reactions = message.reactions
+        self.change_live_post(str(payload.message_id), clear)
 
-            for reaction in reactions:
-                async for reacter in reaction.users():
-                    if reacter == user and reaction.emoji != user_reaction.emoji:
-                        await message.remove_reaction(user_reaction, user)
+    async def on_raw_reaction_clear_emoji(self, payload):
+        emoji = str(payload.emoji)
 
-    # returns the data required to plot the distribution graph for a specific member
-    def member_distribution_data(self, member):
-        guild_id_str = str(member.guild.id)
-        if bot.image_scores.get(guild_id_str, None) is None:
-            return {}
+        def clear_emoji(live_post):
+            live_post["votes"].pop(emoji, None)
+            for user_id, voted in list(live_post["voters"].items()):
+                voted.discard(emoji)
+                if not voted:
+                    live_post["voters"].pop(user_id)
 
-        member_data = bot.image_scores[guild_id_str]["graph"].get(str(member.id), None)
-        if member_data is None:
-            return {}
+        self.change_live_post(str(payload.message_id), clear_emoji)
 
-        dist_dict = defaultdict(int)
-        for image_score, _ in member_data:
-            dist_dict[image_score] += 1
+    # make a change to a post's tally now, or once it's fetched if that's underway. posts with neither
+    # aren't being tracked, and will be fetched whole when needed
+    def change_live_post(self, message_id, change):
+        live_post = self.live_posts.get(message_id)
+        if live_post is not None:
+            change(live_post)
+        elif message_id in self.pending_reactions:
+            self.pending_reactions[message_id].append(change)
 
-        return dist_dict
+    # take back a reaction that doesn't count. its remove event then updates the tally
+    def remove_vote(self, payload):
+        self.queue_unreaction(payload.channel_id, payload.message_id, str(payload.emoji), payload.user_id)
 
-    # returns the data required to plot the distribution graph for the server
-    def guild_distribution_data(self, guild):
-        guild_id_str = str(guild.id)
-        if bot.image_scores.get(guild_id_str, None) is None:
-            return {}
+    # a deleted post can't be scored, so stop voting on it straight away
+    async def on_raw_message_delete(self, payload):
+        self.outbound.drop(payload.message_id)
 
-        server_data = bot.image_scores[guild_id_str]["graph"]
-        dist_dict = defaultdict(int)
+        message_id = str(payload.message_id)
+        if message_id in self.current_images:
+            self.close_post(message_id)
 
-        for user, user_posts in server_data.items():
-            for image_score, _ in user_posts:
-                dist_dict[image_score] += 1
+    async def on_raw_bulk_message_delete(self, payload):
+        for message_id in payload.message_ids:
+            self.outbound.drop(message_id)
+            message_id = str(message_id)
+            if message_id in self.current_images:
+                self.close_post(message_id)
 
-        return dist_dict
+    # members joining or leaving make any cached lookup of them out of date
+    async def on_member_join(self, member):
+        self.members.forget(member.guild.id, member.id)
 
-    # helper function for saving a dictionary to JSON
-    async def save(self, data, file_path):
-        async with aiofiles.open(file_path, "w+") as f:
-            await f.write(json.dumps(data, indent=4))
+    async def on_member_remove(self, member):
+        self.members.forget(member.guild.id, member.id)
+
+    # returns the data required to plot the distribution graph for a specific member
+    def member_distribution_data(self, member):
+        return self.store.distribution(member.guild.id, member.id)
+
+    # returns the data required to plot the distribution graph for the server
+    def guild_distribution_data(self, guild):
+        return self.store.distribution(guild.id)
+
+    # write out any pending changes straight away, e.g. before shutting down
+    async def flush(self):
+        await self.store.flush()
+        await self.backfill.flush()
+
+    # make sure nothing is lost when the bot is shut down
+    async def close(self):
+        await self.flush()
+        self.renderer.shutdown()
+        if self.reposts is not None:
+            await self.reposts.close()
+        await super().close()
 
     # helper function to get a server's key
     def get_key(self, guild):
@@ -248,60 +659,70 @@ class VoteClient(commands.Bot):
 # allow dynamic command prefixes
 def command_prefix(bot, message):
     try:
-        # prefix = bot.prefixes[str(message.guild.id)]
-        prefix = bot.preferences["prefixes"][str(message.guild.id)]
+        prefix = bot.prefixes[message.guild.id]
     except KeyError:
         prefix = bot.default_prefix
 
     return prefix
 
 
-bot = VoteClient(command_prefix=command_prefix)
-bot.remove_command("help") # remove default help command, to be replaced with our own
+# the bot the commands below use, once make_bot() has made it. it isn't made when this file is imported,
+# so chart rendering processes (which import it again) and bench.py don't start one they don't want
+bot = None
+
+# make the bot and give it the commands below, without connecting it
+def make_bot(shard_ids=None, shard_count=None):
+    global bot
+    bot = VoteClient(command_prefix=command_prefix, shard_ids=shard_ids, shard_count=shard_count)
+    bot.remove_command("help") # remove default help command, to be replaced with our own
+    for command in [value for value in globals().values() if isinstance(value, commands.Command)]:
+        bot.add_command(command)
+
+    return bot
 
 ### Bot commands ###
 
-@bot.command(description="Show the distribution of post scores, either for the whole server or for a specific user",
+@commands.command(description="Show the distribution of post scores, either for the whole server or for a specific user",
              help="Call this function on its own for stats on the whole server. Provide a single user for data on their posts specifically. Example usage: `<prefix>distribution <user mention>`")
 async def distribution(ctx, member: discord.Member = None):
     if member is not None:
-        data = bot.member_distribution_data(member)
         nick = member.nick
         if nick is None:
             nick = member.name
         title = f"Distribution of {nick}'s post scores in {ctx.guild.name}"
     else:
-        data = bot.guild_distribution_data(ctx.guild)
         title = f"Distribution of post scores in {ctx.guild.name}"
 
-    if not data:
-        await ctx.send("I don't have enough data to produce a distribution graph. Either post some images, or if you have already done so, wait for the voting period to end.")
-        return
+    if member is not None:
+        data = bot.member_distribution_data(member)
+    else:
+        data = bot.guild_distribution_data(ctx.guild)
 
-    fig, ax = plt.subplots(figsize=(8, 6))
+    async def make():
+        if not data:
+            return None
+
+        image_scores, score_freqs = list(data.keys()), list(data.values())
+        return await bot.renderer.render(render_distribution, image_scores, score_freqs, title)
 
-    image_scores, score_freqs = data.keys(), data.values()
+    key = ("distribution", ctx.guild.id, member.id if member is not None else None, bot.data_version(ctx.guild.id))
+    try:
+        chart = await bot.charts.get(key, make)
+    except RendererBusy:
+        await ctx.send(bot.renderer_busy_message)
+        return
 
-    plt.bar(image_scores, score_freqs, color='white')
-    plt.xticks(rotation=90)
-    plt.ylabel('Frequency', color='white')
-    plt.title(title, color='white')
+    if chart is None:
+        await ctx.send("I don't have enough data to produce a distribution graph. Either post some images, or if you have already done so, wait for the voting period to end.")
+        return
 
-    # Whiten
-    ax.spines['bottom'].set_color('white')
-    ax.spines['top'].set_color('white')
-    ax.spines['right'].set_color('white')
-    ax.spines['left'].set_color('white')
-    ax.tick_params(axis='x', colors='white')
-    ax.tick_params(axis='y', colors='white')
-    ax.xaxis.label.set_color('white')
-    ax.yaxis.label.set_color('white')
+    from history import histogram_stats
 
-    plt.savefig('post_dist.png', transparent=True)
-    plt.clf()
+    stats = histogram_stats(data)
+    summary = f"{stats['count']} posts, mean {stats['mean']:.2f}, median {stats[50]:g} (middle half between {stats[25]:g} and {stats[75]:g})"
 
-    file = discord.File('post_dist.png', filename='post_dist.png')
-    await ctx.channel.send(file=file)
+    file = discord.File(chart, filename='post_dist.png')
+    await ctx.send(summary, file=file)
 
 
 @distribution.error
@@ -309,25 +730,71 @@ async def distributionerror(ctx, error): # fill in
     if isinstance(error, commands.errors.MemberNotFound):
         await ctx.send("That's not a valid member. Please use the desired user's mention as the only argument.")
 
-@bot.command(aliases=['lb'],
+# a stretch of time for the leaderboard, as (since, until) unix times with None for an open end: `day`,
+# `week`, `month` or `year` for the last one of those, a number of days like `10d`, a date like
+# `2024-01-31` for everything since then, or two dates like `2024-01-01..2024-02-01`
+class Window(commands.Converter):
+    periods = {"day": 1, "week": 7, "month": 30, "year": 365}
+
+    async def convert(self, ctx, argument):
+        argument = argument.lower()
+        if argument in self.periods:
+            return time.time() - 24*60*60*self.periods[argument], None
+
+        if argument.endswith("d") and argument[:-1].isdigit():
+            return time.time() - 24*60*60*int(argument[:-1]), None
+
+        try:
+            dates = [datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp() for date in argument.split("..")]
+        except ValueError:
+            raise commands.BadArgument(f"{argument} isn't a period of time")
+
+        if len(dates) == 1:
+            return dates[0], None
+        if len(dates) == 2 and dates[0] < dates[1]:
+            return dates[0], dates[1]
+        raise commands.BadArgument(f"{argument} isn't a period of time")
+
+def describe_window(since, until):
+    def date(timestamp):
+        return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%-d %b %Y")
+
+    if since is None:
+        return f"Before {date(until)}" if until is not None else "All time"
+    return f"{date(since)} to {date(until)}" if until is not None else f"Since {date(since)}"
+
+@commands.command(aliases=['lb'],
             description="Display the leaderboard!",
-            help="You don't need any help with that command!")
-async def leaderboard(ctx):
+            help="Shows the top of the leaderboard. Provide a page number to see further down, and/or `day`, `week`, `month`, `year`, a number of days (`10d`) or dates (`2024-01-01..2024-02-01`) to only count posts from then. Example usage: `<prefix>leaderboard week 2`")
+async def leaderboard(ctx, window: typing.Optional[Window] = None, page: int = 1):
     board = ""
-    total_points = 0
-    posts_submitted = 0
-    try:
-        leaderboard_data = bot.image_scores[str(ctx.guild.id)]["leaderboard"]
-    except KeyError:
+    if window is None:
+        ranking = bot.store.ranking(ctx.guild.id)
+    else:
+        windowed = bot.store.windowed(ctx.guild.id)
+        ranking = None
+        if windowed is not None:
+            ranking, since, until = windowed.window(*window)
+            board = f"{describe_window(since, until)}\n\n"
+
+    if ranking is None:
         await ctx.send("I don't have enough data to produce a leaderboard. Either post some images, or if you have already done so, wait for the voting period to end.")
         return
 
-    for pos, (user_id, info) in enumerate(sorted(leaderboard_data.items(), key=lambda user: user[1]["score"], reverse=True), 1):
-        score, submitted = info["score"], info["submitted"]
-        try:
-            user = await ctx.guild.fetch_member(int(user_id))
-        except discord.errors.NotFound:
-            print(f"Leaderboard: user {user_id} no longer in server. Skipping.")
+    if not len(ranking):
+        await ctx.send("No posts finished voting in that time.")
+        return
+
+    num_pages = (len(ranking) - 1) // bot.leaderboard_page_size + 1
+    page = min(max(page, 1), num_pages)
+    start_rank = (page - 1) * bot.leaderboard_page_size + 1
+    leaderboard_data = ranking.page(start_rank, bot.leaderboard_page_size)
+
+    members = await bot.members.resolve(ctx.guild, [user_id for user_id, _, _ in leaderboard_data])
+
+    for pos, (user_id, score, submitted) in enumerate(leaderboard_data, start_rank):
+        user = members[user_id]
+        if user is None:
             continue
 
         nick = user.nick
@@ -335,179 +802,387 @@ async def leaderboard(ctx):
             nick = user.name
 
         board += f"{pos}. {nick}: {score} ({score / submitted :.1f} avg.)\n"
-        total_points += score
-        posts_submitted += submitted
-
-    board += f"\ Total submissins: {posts_submitted}. Average score: {total_points / posts_submitted : .2f}."
-
-    # pull records data
-    records = bot.image_scores[str(ctx.guild.id)]["records"]
-    best_message_id, best_channel_id, best_score = records["best"]
-    worst_message_id, worst_channel_id, worst_score = records["worst"]
-
-    best_channel = await bot.fetch_channel(best_channel_id)
-    worst_channel = await bot.fetch_channel(worst_channel_id)
 
-    best_post = await best_channel.fetch_message(best_message_id)
-    best_post_url = best_post.attachments[0].url
+    board += f"\nTotal submissions: {ranking.total_submitted}. Average score: {ranking.total_score / ranking.total_submitted : .2f}."
 
-    worst_post = await worst_channel.fetch_message(worst_message_id)
-    worst_post_url = worst_post.attachments[0].url
-
-    best_post_author = best_post.author
-    worst_post_author = worst_post.author
+    # the records are for all time, so they're only shown with the all time leaderboard
+    if page > 1 or window is not None:
+        embed = discord.Embed(title=f"{ctx.guild.name} Leaderboards", description=board)
+        embed.set_footer(text=f"Page {page} of {num_pages}")
+        await ctx.send(embed=embed)
+        return
 
+    # pull records data. records for posts from before their messages were kept can't be linked to
+    records = bot.store.records(ctx.guild.id)
+    for name, (message_id, channel_id, record_score) in (("Best", records["best"]), ("Worst", records["worst"])):
+        if not message_id:
+            board += f"\n{name} post: one from before I kept track of them ({record_score} points)"
+            continue
 
-    board += f"\nBest post: [this one]({best_post_url}), by {best_post_author.mention} ({best_score} points)"
-    board += f"\nWorst post: [this one]({worst_post_url}), by {worst_post_author.mention} ({worst_score} points)"
+        channel = await bot.fetch_channel(channel_id)
+        post = await channel.fetch_message(message_id)
+        board += f"\n{name} post: [this one]({post.attachments[0].url}), by {post.author.mention} ({record_score} points)"
 
     embed = discord.Embed(title=f"{ctx.guild.name} Leaderboards", description=board)
     embed.set_thumbnail(url=ctx.guild.icon_url)
     embed.set_author(name="james", icon_url=bot.icon_url)
+    if num_pages > 1:
+        embed.set_footer(text=f"Page 1 of {num_pages}")
     await ctx.send(embed=embed)
 
-@bot.command(hidden=True)
-async def calc_records(ctx):
-    if ctx.author.id != bot.owner_id:
+@commands.command(description="Show where a user stands on the leaderboard",
+             help="Call this function on its own to see your own rank, or provide a single user to see theirs. Example usage: `<prefix>rank <user mention>`")
+async def rank(ctx, member: discord.Member = None):
+    if member is None:
+        member = ctx.author
+
+    nick = member.nick
+    if not nick:
+        nick = member.name
+
+    ranking = bot.store.ranking(ctx.guild.id)
+    position = ranking.rank(member.id) if ranking is not None else None
+    if position is None:
+        await ctx.send(f"{nick} isn't on the leaderboard yet. Post some images, or if you have already done so, wait for the voting period to end.")
+        return
+
+    score, submitted = ranking.totals[member.id]
+    await ctx.send(f"{nick} is ranked #{position} of {len(ranking)} with {score} points ({score / submitted :.1f} avg.)")
+
+@rank.error
+async def rankerror(ctx, error):
+    if isinstance(error, commands.errors.MemberNotFound):
+        await ctx.send("That's not a valid member. Please use the desired user's mention as the only argument.")
+
+@commands.command(description="Show a post's current score while voting on it is still open",
+             help="Provide the ID or link of a post that's still open for voting. Example usage: `<prefix>score <message link>`")
+async def score(ctx, post):
+    message_id = post.rstrip('/').split('/')[-1]
+    open_post = bot.current_images.get(message_id)
+    if open_post is None or message_id in bot.closing:
+        await ctx.send("That post isn't open for voting. Check the ID or link and try again.")
         return
 
-    guild_id_str = str(ctx.guild.id)
+    live_post = await bot.get_live_post(message_id)
+    if live_post is None or live_post["guild_id"] != ctx.guild.id:
+        await ctx.send("I can't find that post in this server.")
+        return
+
+    minutes_left = max(int((open_post[1] - time.time()) / 60), 0)
+    await ctx.send(f"That post has {bot.tally_score(live_post)} points so far, with {minutes_left // 60}h {minutes_left % 60}m of voting left.")
+
+@score.error
+async def scoreerror(ctx, error):
+    if isinstance(error, commands.errors.MissingRequiredArgument):
+        await ctx.send(f"Please provide the ID or link of a post. Example usage: `{command_prefix(bot, ctx.message)}score <message link>`")
+
+# runs one of the owner's backfills over the server's image channel, showing progress in a message that's
+# kept up to date as it goes. returns (state, number of posts) like Backfill.run, or None if it didn't finish
+async def run_backfill(ctx, job, new_state, fold):
     image_channel_id = bot.preferences["image_channels"][str(ctx.guild.id)]
     image_channel = bot.get_channel(image_channel_id)
 
-    messages = await image_channel.history(limit=None).flatten()
-    num_posts = len(messages)
+    resuming = bot.backfill.resumable(job, ctx.guild.id)
+    status = await ctx.send("Resuming from where the last run got to..." if resuming else "Reading through the channel's history...")
 
-    bot.image_scores[guild_id_str]["records"] = {"best": (0, 0, -1), "worst": (0, 0, 100000)}
-    best_score, worst_score = -1, 1000000
+    async def report(posts, rate):
+        await status.edit(content=f"Read {posts} posts so far ({rate:.0f} posts/s)...")
 
-    for post_num, post in enumerate(reversed(messages), 1):
-        if bot.current_images.get(str(post.id)):
-            break
-        author_id_str = str(post.author.id)
-        key = bot.get_key(ctx.guild)
-        image_score = sum(key.get(react.emoji, 0) * (react.count-1) for react in post.reactions)
+    try:
+        result = await bot.backfill.run(job, image_channel, new_state, fold,
+                                        lambda post: str(post.id) in bot.current_images, report)
+    except discord.errors.HTTPException as error:
+        await status.edit(content=f"Stopped early ({error}). Run the command again to carry on from where it got to.")
+        return None
 
-        if image_score < worst_score:
-            worst_score = image_score
-            bot.image_scores[guild_id_str]["records"]["worst"] = (post.id, post.channel.id, image_score)
+    if result is None:
+        await status.edit(content="That's already running for this server.")
+        return None
 
-        if image_score > best_score:
-            best_score = image_score
-            bot.image_scores[guild_id_str]["records"]["best"] = (post.id, post.channel.id, image_score)
+    await status.edit(content=f"Read {result[1]} posts.")
+    return result
 
+@commands.command(hidden=True)
+async def calc_records(ctx):
+    if ctx.author.id != bot.owner_id:
+        return
+
+    def fold(records, post, post_num):
+        image_score = bot.score_votes(ctx.guild.id, bot.message_votes(post))
+
+        if image_score < records["worst"][2]:
+            records["worst"] = (post.id, post.channel.id, image_score)
+
+        if image_score > records["best"][2]:
+            records["best"] = (post.id, post.channel.id, image_score)
+
+    result = await run_backfill(ctx, "records", new_records, fold)
+    if result is None:
+        return
+
+    bot.store.set_records(ctx.guild.id, result[0])
     await ctx.send("OK, records for this server set.")
-    await bot.save(bot.image_scores, "new_posts.json")
 
-@bot.command(description="Plot a graph of users' points over time (displays best if all submitters have a different role colour in Discord)",
-             help="You don't need any help with that command!")
-async def graph(ctx):
+@commands.command(hidden=True)
+async def calc_hashes(ctx):
+    if ctx.author.id != bot.owner_id:
+        return
+
+    # hash a few posts' images at once. the checkpoint can get ahead of the ones still being hashed,
+    # so they're all finished before the backfill stops, however it stops
+    reposts = bot.repost_finder()
+    known = reposts.index(ctx.guild.id).message_ids()
+    hashing = set()
+    added = 0
+
+    async def hash_post(post):
+        nonlocal added
+        hash = await reposts.hash_attachment(post.attachments[0])
+        if hash is not None:
+            reposts.add(ctx.guild.id, hash, post.id, post.channel.id)
+            added += 1
+
+    async def fold(state, post, post_num):
+        if not post.attachments or post.id in known:
+            return
+
+        hashing.add(asyncio.ensure_future(hash_post(post)))
+        if len(hashing) >= reposts.download_limit:
+            _, still_hashing = await asyncio.wait(hashing, return_when=asyncio.FIRST_COMPLETED)
+            hashing.intersection_update(still_hashing)
+
+    try:
+        result = await run_backfill(ctx, "hashes", dict, fold)
+    finally:
+        if hashing:
+            await asyncio.wait(hashing)
+
+    if result is None:
+        return
+
+    await ctx.send(f"OK, added {added} images to this server's repost checks ({len(reposts.index(ctx.guild.id))} in total).")
+
+@commands.command(hidden=True)
+async def calc_distributions(ctx):
+    if ctx.author.id != bot.owner_id:
+        return
+
+    if bot.store.history(ctx.guild.id) is None:
+        await ctx.send("There are no finished posts in this server yet.")
+        return
+
+    bot.store.rebuild_distributions(ctx.guild.id)
+    bot.bump_data_version(ctx.guild.id)
+    await ctx.send("OK, score distributions for this server counted again.")
+
+# `top<N>` (only the N highest scorers) or `last<K>` (only the server's last K posts) for the graph
+class GraphOption(commands.Converter):
+    async def convert(self, ctx, argument):
+        for name in ("top", "last"):
+            if argument.lower().startswith(name) and argument[len(name):].isdigit() and int(argument[len(name):]) > 0:
+                return name, int(argument[len(name):])
+
+        raise commands.BadArgument(f"{argument} isn't a graph option")
+
+@commands.command(description="Plot a graph of users' points over time (displays best if all submitters have a different role colour in Discord)",
+             help="Call this function on its own to graph everyone's points over all time. Provide a number of days to only show recent posts, `last<number>` to only show the last few posts, `top<number>` to only show the top few users, and/or some users to only show them. Example usage: `<prefix>graph 30 top5` or `<prefix>graph last500 <user mention> <user mention>`")
+async def graph(ctx, days: typing.Optional[int] = None, *chosen: typing.Union[GraphOption, discord.Member]):
     guild = ctx.guild
-    guild_id_str = str(guild.id)
     guild_transparency_int = int(bot.preferences["transparency"].get(str(guild.id), 0))
-    try:
-        graph_data = bot.image_scores[guild_id_str]["graph"]
-        total_posts = bot.image_scores[guild_id_str]["submitted"]
-    except KeyError:
+    history = bot.store.history(guild.id)
+    if history is None:
         await ctx.send("There's no data to graph. Either post some images, or if you have already done so, wait for the voting period to end.")
         return
 
-    # create a map ID string -> member object
+    options = dict(option for option in chosen if isinstance(option, tuple))
+    chosen = [member for member in chosen if not isinstance(member, tuple)]
+    since = time.time() - 60*60*24*days if days else None
 
-    async def catch_fetch(user_id):
-        try:
-            return await guild.fetch_member(user_id)
-        except discord.errors.NotFound:
-            print(f"Graph: user {user_id} no longer in server. Skipping.")
+    async def make():
+        from history import downsample
+
+        # create a map ID -> member object, leaving out anyone who's left the server
+        if chosen:
+            members = {member.id: member for member in chosen}
+        else:
+            members = await bot.members.resolve(guild, history.users)
+            members = {user_id: member for user_id, member in members.items() if member is not None}
+
+        curves = history.curves(user_ids=list(members.keys()), since=since, last=options.get("last"))
+        if not curves:
             return None
 
-    # members = {user_id: await guild.fetch_member(user_id) for user_id in graph_data.keys()}
-    members = {user_id: await catch_fetch(user_id) for user_id in graph_data.keys()}
-    members = {user_id: member for user_id, member in members.items() if member is not None}
-    densities = {member: np.zeros(total_posts+1) for member in members.values()}
-    cumulatives = densities.copy()
+        # only the top few users' lines, and no more points on each than can be told apart, so drawing
+        # takes about as long however long the server's history is
+        lines = []
+        for user_id in sorted(curves.keys(), key=lambda user_id: curves[user_id][1][-1], reverse=True)[:options.get("top")]:
+            member = members[user_id]
+            nick = member.nick
+            if not nick:
+                nick = member.name
 
-    for user_id, post_data in graph_data.items():
-        member = members.get(user_id)
-        if member is None:
-            continue
+            post_nums, totals = curves[user_id]
+            kept = downsample(post_nums, totals, bot.graph_points)
+            lines.append((nick, tuple(c/255 for c in member.colour.to_rgb()), post_nums[kept], totals[kept]))
 
-        for (image_score, post_num) in post_data:
-            densities[member][post_num] = image_score
+        return await bot.renderer.render(render_graph, lines, bool(guild_transparency_int))
 
-        cumulatives[member] = np.cumsum(densities[member])
+    # graphs of the last few days move on by themselves, so those are only reused within the same day
+    key = ("graph", guild.id, tuple(sorted(member.id for member in chosen)), days, int(time.time() // (60*60*24)) if days else None,
+           tuple(sorted(options.items())), guild_transparency_int, bot.data_version(guild.id))
+    try:
+        chart = await bot.charts.get(key, make)
+    except RendererBusy:
+        await ctx.send(bot.renderer_busy_message)
+        return
 
-    fig, ax = plt.subplots(figsize=(12, 8))
-    for member in sorted(cumulatives.keys(), key=lambda memb: cumulatives[memb][-1], reverse=True):
-        nick = member.nick
-        if not nick:
-            nick = member.name
+    if chart is None:
+        await ctx.send("There's no data to graph for that time. Try a longer time, or leave it out to graph all time.")
+        return
 
-        plt.plot(range(total_posts+1), cumulatives[member], label=nick, color=tuple(c/255 for c in member.colour.to_rgb()))
+    file = discord.File(chart, filename='graph.png')
+    await ctx.send('Tada!', file=file)
 
+@commands.command(hidden=True)
+async def convert(ctx):
+    if ctx.author.id != bot.owner_id:
+        return
 
-    legend = plt.legend(framealpha=0)
+    def fold(guild_scores, post, post_num):
+        author_id_str = str(post.author.id)
+        votes = bot.message_votes(post)
+        image_score = bot.score_votes(ctx.guild.id, votes)
 
-    if guild_transparency_int:
-        for text in legend.get_texts():
-            text.set_color("white")
+        # keep the votes too, so these posts can be rescored without reading the channel again
+        guild_scores["ledger"][str(post_num)] = [post.id, post.channel.id, votes]
 
-        plt.xlabel('Total Submissions', color='white')
-        plt.title(f'Graph of user scores over time', color='white')
-        plt.ylabel('User scores', color='white')
+        if not guild_scores["leaderboard"].get(author_id_str, False):
+            guild_scores["leaderboard"][author_id_str] = {"score": image_score, "submitted": 1}
+            guild_scores["graph"][author_id_str] = [(image_score, post_num, snowflake_time(post.id))]
+        else:
+            guild_scores["leaderboard"][author_id_str]["score"] += image_score
+            guild_scores["leaderboard"][author_id_str]["submitted"] += 1
+            guild_scores["graph"][author_id_str].append((image_score, post_num, snowflake_time(post.id)))
 
-        # Whiten
-        ax.spines['bottom'].set_color('white')
-        ax.spines['top'].set_color('white')
-        ax.spines['right'].set_color('white')
-        ax.spines['left'].set_color('white')
-        ax.tick_params(axis='x', colors='white')
-        ax.tick_params(axis='y', colors='white')
-        ax.xaxis.label.set_color('white')
-        ax.yaxis.label.set_color('white')
-    else:
-        plt.xlabel('Total Submissions')
-        plt.title(f'Graph of user scores over time')
-        plt.ylabel('User scores')
+    result = await run_backfill(ctx, "convert", lambda: {"leaderboard": {}, "graph": {}, "submitted": 0, "ledger": {}}, fold)
+    if result is None:
+        return
 
-    plt.savefig('graph.png', transparent=bool(guild_transparency_int))
-    plt.clf()
+    guild_scores, num_posts = result
+    guild_scores["submitted"] = num_posts
 
-    file = discord.File('graph.png', filename='graph.png')
-    await ctx.channel.send('Tada!', file=file)
+    bot.store.replace_guild(ctx.guild.id, guild_scores)
+    bot.bump_data_version(ctx.guild.id)
+    await ctx.send("OK, historical data converted.")
 
-@bot.command(hidden=True)
-async def convert(ctx):
+@commands.command(description="Score all of the server's past posts again using the current emoji values",
+             help="Use this after changing the emoji values to apply them to posts that have already finished, as well as future ones. Posts from before votes were recorded keep their old scores.")
+async def rescore(ctx):
+    if not has_general_permission(ctx.author):
+        await ctx.send("Sorry, you don't have permission to do that.")
+        return
+
+    started = time.perf_counter()
+    rescored = bot.store.rescore(ctx.guild.id, bot.get_key(ctx.guild))
+    if not rescored:
+        await ctx.send("I don't have the votes for any of this server's past posts, so there's nothing to rescore.")
+        return
+
+    bot.bump_data_version(ctx.guild.id)
+    await ctx.send(f"OK, rescored {rescored} posts in {1000*(time.perf_counter() - started):.0f}ms.")
+
+# roughly where time is going, for the owner. the full set is served for Prometheus (see metrics.py)
+@commands.command(hidden=True)
+async def stats(ctx):
     if ctx.author.id != bot.owner_id:
         return
 
-    guild_id_str = str(ctx.guild.id)
-    image_channel_id = bot.preferences["image_channels"][str(ctx.guild.id)]
-    image_channel = bot.get_channel(image_channel_id)
+    def summary(histogram):
+        return f"{histogram.count}× avg {1000*histogram.sum/histogram.count:.0f}ms, p99 < {1000*histogram.quantile(0.99):g}ms"
 
-    messages = await image_channel.history(limit=None).flatten()
-    num_posts = len(messages)
+    def table(name, label):
+        histograms = bot.metrics.histograms_named(name)
+        rows = sorted(histograms.items(), key=lambda item: item[1].sum, reverse=True)[:8]
+        return [f"  {dict(labels).get(label, '-')}: {summary(histogram)}" for labels, histogram in rows]
 
-    bot.image_scores[guild_id_str] = {"leaderboard": {}, "graph": {}, "submitted": num_posts}
+    uptime = int(time.time() - bot.metrics.started)
+    lines = [f"Up {uptime // 3600}h {uptime % 3600 // 60}m, {len(bot.current_images)} open posts, "
+             f"{bot.metrics.counters.get(('james_posts_finished_total', ()), 0)} posts finished"]
 
-    for post_num, post in enumerate(reversed(messages), 1):
-        if bot.current_images.get(str(post.id)):
-            break
-        author_id_str = str(post.author.id)
-        key = bot.get_key(ctx.guild)
-        image_score = sum(key.get(react.emoji, 0) * (react.count-1) for react in post.reactions)
-        if not bot.image_scores[guild_id_str]["leaderboard"].get(author_id_str, False):
-            bot.image_scores[guild_id_str]["leaderboard"][author_id_str] = {"score": image_score, "submitted": 1}
-            bot.image_scores[guild_id_str]["graph"][author_id_str] = [(image_score, post_num)]
-        else:
-            bot.image_scores[guild_id_str]["leaderboard"][author_id_str]["score"] += image_score
-            bot.image_scores[guild_id_str]["leaderboard"][author_id_str]["submitted"] += 1
-            bot.image_scores[guild_id_str]["graph"][author_id_str].append((image_score, post_num))
+    lag = bot.metrics.histograms_named("james_event_loop_lag_seconds").get(())
+    if lag is not None:
+        lines.append(f"Event loop lag: {summary(lag)}")
 
-    await ctx.send("OK, historical data converted.")
-    await bot.save(bot.image_scores, "new_posts.json")
+    for title, name, label in (("Commands", "james_command_seconds", "command"), ("Events", "james_event_seconds", "event"),
+                               ("Saves", "james_save_seconds", "file"), ("Finishing posts", "james_finalize_seconds", None)):
+        rows = table(name, label)
+        if rows:
+            lines.append(f"{title}:")
+            lines.extend(rows)
+
+    requests = sorted(bot.metrics.counters_named("james_rest_requests_total").items(), key=lambda item: item[1], reverse=True)[:8]
+    if requests:
+        lines.append("REST requests:")
+        lines.extend(f"  {dict(labels)['method']} {dict(labels)['route']}: {count}" for labels, count in requests)
+
+    await ctx.send("```\n" + "\n".join(lines) + "\n```")
 
-@bot.command(description="Change james' prefix for this server",
+@commands.command(name="queue", hidden=True)
+async def queue_stats(ctx):
+    if ctx.author.id != bot.owner_id:
+        return
+
+    lines = [f"{name}: {waiting} waiting, {done} sent, {1000*average:.0f}ms average wait, {1000*longest:.0f}ms longest"
+             for name, (waiting, done, average, longest) in bot.outbound.stats().items()]
+    lines.append(f"{bot.outbound.merged} merged into others, {bot.outbound.dropped} dropped")
+    await ctx.send("\n".join(lines))
+
+@commands.command(hidden=True)
+async def migrate(ctx, scores_path="scores.json"):
+    if ctx.author.id != bot.owner_id:
+        return
+
+    if not isinstance(bot.store, SqliteStore):
+        await ctx.send("I'm not using the database yet. Set the storage to `sqlite` and restart me first.")
+        return
+
+    # import the JSON files the JSON storage would have loaded, then pick up the open posts
+    source = JsonStore(scores_path=scores_path)
+    bot.store.import_store(source)
+    bot.rebuild_routes()
+    bot.charts.clear()
+    bot.load_expiry_queue()
+    bot.new_post.set()
+
+    await ctx.send(f"OK, imported {len(source.scores)} servers and {len(source.open_posts)} open posts into the database.")
+
+@commands.command(description="Download this server's posts and scores",
+             help="Sends every finished post and each user's totals as files for looking at in other programs. Give `parquet` for Parquet files instead of CSV. Example usage: `<prefix>export` or `<prefix>export parquet`")
+async def export(ctx, format="csv"):
+    if not has_general_permission(ctx.author):
+        await ctx.send("Sorry, you don't have permission to do that.")
+        return
+
+    format = format.lower()
+    if format not in FORMATS:
+        await ctx.send(f"I can export as {' or '.join(FORMATS)}. Example usage: `{command_prefix(bot, ctx.message)}export csv`")
+        return
+
+    # the files go to disk as they're made rather than being built up in memory
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            paths = await export_guild(bot.store, ctx.guild.id, directory, format)
+        except ImportError:
+            await ctx.send("Sorry, Parquet exports aren't set up on this bot. Try `csv` instead.")
+            return
+
+        if sum(os.path.getsize(path) for path in paths) > ctx.guild.filesize_limit:
+            await ctx.send("Sorry, the export is too big for me to upload here. My owner can make it with `python export.py` instead.")
+            return
+
+        await ctx.send("Here you go!", files=[discord.File(path, filename=os.path.basename(path)) for path in paths])
+
+@commands.command(description="Change james' prefix for this server",
              help="Provide a single prefix (no spaces allowed) to replace the existing one. Example usage: `<prefix>prefix !`")
 async def prefix(ctx, *args):
     if has_general_permission(ctx.author):
@@ -517,12 +1192,13 @@ async def prefix(ctx, *args):
             return
 
         bot.preferences["prefixes"][str(ctx.guild.id)] = args[0]
+        bot.rebuild_routes()
         await ctx.send(f'Prefix updated to `{args[0]}` successfully.')
-        await bot.save(bot.preferences, 'preferences.json')
+        bot.store.save_preferences(ctx.guild.id)
     else:
         await ctx.send("Sorry, you don't have permission to do that.")
 
-@bot.command(description="Give a user permission to change james' settings",
+@commands.command(description="Give a user permission to change james' settings",
              help="Specify a single user to extend permissions to. Example usage: `<prefix>give_permission <user mention>`")
 async def give_permission(ctx, target: discord.Member):
     if has_top_permission(ctx.author):
@@ -537,12 +1213,12 @@ async def give_permission(ctx, target: discord.Member):
             bot.preferences["admins"][str(ctx.guild.id)][str(target.id)] = 1
 
         await ctx.send(f'OK, {target.mention} now has permission to use more of my commands.')
-        await bot.save(bot.preferences, 'preferences.json')
+        bot.store.save_preferences(ctx.guild.id)
 
     else:
         await ctx.send("Sorry, only administrators can modify my permissions.")
 
-@bot.command(description="Take away a user's permission to change james' settings",
+@commands.command(description="Take away a user's permission to change james' settings",
              help="Provide a single user to remove permissions for. Example usage: `<prefix>take_permission <user mention>`")
 async def take_permission(ctx, target: discord.Member):
     if has_top_permission(ctx.author):
@@ -552,17 +1228,18 @@ async def take_permission(ctx, target: discord.Member):
         try:
             bot.preferences["admins"][str(ctx.guild.id)].pop(str(target.id))
             await ctx.send(f'OK, {target.mention} has had his permissions revoked.')
-            await bot.save(bot.admins, 'admins.json')
+            bot.store.save_preferences(ctx.guild.id)
         except KeyError:
             await ctx.send("Hmm, I don't think that person had extended permissions anyway!")
 
     else:
         await ctx.send("Sorry, only administrators can modify my permissions.")
 
-@bot.command(hidden=True)
+@commands.command(hidden=True)
 async def stop(ctx):
     if ctx.author.id == bot.owner_id:
         await ctx.send('Shutting down...')
+        await bot.flush()
         sys.exit()
     else:
         await ctx.send('Sorry, only my owner can tell me to do that 😋')
@@ -583,13 +1260,14 @@ def has_general_permission(member):
 def has_top_permission(member):
     return (member.guild_permissions.administrator or member.id == bot.owner_id)
 
-@bot.command(description="Set the image channel for this server",
+@commands.command(description="Set the image channel for this server",
              help="Provide a single channel for james to monitor for new posts. Example usage: `<prefix>setchannel <channel mention>`")
 async def setchannel(ctx, channel : discord.TextChannel):
     if has_general_permission(ctx.author):
         bot.preferences["image_channels"][str(ctx.guild.id)] = channel.id
+        bot.rebuild_routes()
         await ctx.send(f"OK, {channel.mention} is now your server's designated image channel!")
-        await bot.save(bot.preferences, 'preferences.json')
+        bot.store.save_preferences(ctx.guild.id)
     else:
         await ctx.send("Sorry, you don't have permission to do that.")
 
@@ -599,14 +1277,14 @@ async def setchannelerr(ctx, error):
         await ctx.send(f"Please provide a single channel mention to set as the image channel. Example usage: `{command_prefix(bot, ctx.message)}setchannel <channel mention>`")
 
 
-@bot.command(description="Toggle graph transparency", help="Toggle the transparency setting for the graph command; transparency works well in dark mode. Example usage: `<prefix>transparency`")
+@commands.command(description="Toggle graph transparency", help="Toggle the transparency setting for the graph command; transparency works well in dark mode. Example usage: `<prefix>transparency`")
 async def transparency(ctx):
     if has_general_permission(ctx.author):
         current_transparency = bot.preferences["transparency"].get(str(ctx.guild.id), 0)
         new_transparency = int(not current_transparency)
         bot.preferences["transparency"][str(ctx.guild.id)] = new_transparency
         await ctx.send(f"OK, graph transparency {'enabled' if new_transparency else 'disabled'}.")
-        await bot.save(bot.preferences, 'preferences.json')
+        bot.store.save_preferences(ctx.guild.id)
     else:
         await ctx.send("Sorry, you don't have permission to do that.")
 
@@ -615,13 +1293,13 @@ async def transparencyerror(ctx, error):
     print(f"Transparency error: ", error)
     pass
 
-@bot.command(description="Choose how long users will have to vote on submissions",
+@commands.command(description="Choose how long users will have to vote on submissions",
              help="Provide a single value for the duration in hours users will be able to vote on an image after it is posted. Example usage: `<prefix>settime 24`")
 async def settime(ctx, arg : float):
     if has_general_permission(ctx.author):
         if arg < 48:
             bot.preferences["timers"][str(ctx.guild.id)] = arg
-            await bot.save(bot.preferences, "preferences.json")
+            bot.store.save_preferences(ctx.guild.id)
             await ctx.send(f"OK, members will now have `{arg}` hour{'' if arg == 1 else 's'} to vote on submissions.")
         else:
             await ctx.send("Sorry, my maximum setting is `48` hours. Try again with a smaller value.")
@@ -633,7 +1311,7 @@ async def settimeerr(ctx, error):
     if isinstance(error, commands.errors.MissingRequiredArgument):
         await ctx.send(f"Please provide a single value (in hours) to set as voting period length. Example usage: `{command_prefix(bot, ctx.message)}setchannel 12` will give users 12 hours to vote on submissions in future.")
 
-@bot.command(description="Add an emoji to the voting options on future submissions",
+@commands.command(description="Add an emoji to the voting options on future submissions",
              help="Provide a single emoji and an integer number of points for the emoji to represent in future. Example usage: `<prefix>add_emoji :laughing: 5`")
 async def add_emoji(ctx, emoji, val: int):
     if not has_general_permission(ctx.author):
@@ -650,7 +1328,7 @@ async def add_emoji(ctx, emoji, val: int):
 
     key = {**prev_key, emoji:val}
     bot.preferences["keys"][str(ctx.guild.id)] = {k: v for k, v in sorted(key.items(), key=lambda item: item[1], reverse=True)}
-    await bot.save(bot.preferences, "preferences.json")
+    bot.store.save_preferences(ctx.guild.id)
 
     await ctx.send(f"OK! {emoji} will be worth {val} points on future submissions!")
 
@@ -663,7 +1341,7 @@ async def add_emojierror(ctx, error):
     else:
         await ctx.send(f"Hmm, something went wrong. Please use the form `{command_prefix(bot, ctx.message)}add_emoji <emoji> <value>`")
 
-@bot.command(description="Remove an emoji from the voting options on current and future submissions",
+@commands.command(description="Remove an emoji from the voting options on current and future submissions",
              help="Provide a single emoji to remove from current/future image voting options. Example usage: `<prefix>remove_emoji :thumbs_up:`")
 async def remove_emoji(ctx, emoji):
     if not has_general_permission(ctx.author):
@@ -677,7 +1355,7 @@ async def remove_emoji(ctx, emoji):
     else:
         prev_key.pop(emoji)
         bot.preferences["keys"][str(ctx.guild.id)] = prev_key
-        await bot.save(bot.preferences, "preferences.json")
+        bot.store.save_preferences(ctx.guild.id)
         await ctx.send(f"OK, from now, votes with {emoji} will not be counted.")
 
 @remove_emoji.error
@@ -687,7 +1365,7 @@ async def remove_emojierror(ctx, error):
     else:
         await ctx.send(f"Hmm, something went wrong. Please use the form `{command_prefix(bot, ctx.message)}remove_emoji <emoji>`")
 
-@bot.command(description="Display the current emoji options for voting",
+@commands.command(description="Display the current emoji options for voting",
              help="You don't need any help with that command!")
 async def emojis(ctx):
     key = bot.get_key(ctx.guild)
@@ -697,7 +1375,7 @@ async def emojis(ctx):
     await ctx.send(key_str)
 
 
-@bot.command(description="Shows this message",
+@commands.command(description="Shows this message",
              help="You don't need any help with that command!")
 async def help(ctx, arg=None):
     commands = bot.commands
@@ -722,7 +1400,7 @@ async def help(ctx, arg=None):
         await ctx.send("That's not a valid command.")
 
 
-@bot.command(hidden=True)
+@commands.command(hidden=True)
 async def remove_reaction(ctx, message_id, reacter : discord.User, emoji):
     if ctx.author.id != bot.owner_id:
         return
@@ -737,4 +1415,17 @@ async def remove_reaction(ctx, message_id, reacter : discord.User, emoji):
     await ctx.send("Emoji removed!")
 ###
 
-bot.run(TOKEN)
+# `python client.py` runs the whole bot in one process. to spread it over several, give each process the
+# shards it should run and the total number of shards, e.g. `python client.py 0,1 4` and
+# `python client.py 2,3 4`. sharded processes always use the SQLite storage, sharing one database
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        make_bot([int(shard_id) for shard_id in sys.argv[1].split(",")], int(sys.argv[2]))
+    else:
+        make_bot()
+
+    # get token from text file
+    with open('token.txt') as f:
+        TOKEN = f.read()
+
+    bot.run(TOKEN)
@@ -0,0 +1,100 @@
+import argparse
+import asyncio
+import csv
+import gzip
+import os
+import sys
+
+# what's in each row of the files, in the order the stores' export_posts and export_users give them
+POST_COLUMNS = ("post_num", "user_id", "score", "posted", "message_id", "channel_id", "votes")
+USER_COLUMNS = ("user_id", "score", "submitted")
+
+FORMATS = ("csv", "parquet")
+
+
+# gzipped CSV, written a chunk of rows at a time
+class CsvWriter:
+    extension = ".csv.gz"
+
+    def __init__(self, path, columns):
+        self.file = gzip.open(path, "wt", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+# a Parquet file with a row group per chunk, zstd compressed. needs pyarrow, which the bot doesn't
+# otherwise use, so it's only imported when asked for
+class ParquetWriter:
+    extension = ".parquet"
+
+    def __init__(self, path, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        types = {"posted": pa.float64(), "votes": pa.string()}
+        self.schema = pa.schema([(column, types.get(column, pa.int64())) for column in columns])
+        self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        self.writer.write_table(self.pa.Table.from_arrays([self.pa.array(values, field.type) for values, field in zip(columns, self.schema)],
+                                                          schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+# write a server's finished posts and its users' totals from `store` into `directory`, one file each,
+# and return their paths. the rows come out of the store a chunk at a time and go straight to the file,
+# so memory use doesn't grow with the server's history. raises ImportError for parquet without pyarrow
+async def export_guild(store, guild_id, directory, format="csv", chunk_size=10000):
+    writer_class = ParquetWriter if format == "parquet" else CsvWriter
+    paths = []
+    for name, columns, chunks in (("posts", POST_COLUMNS, store.export_posts(guild_id, chunk_size)),
+                                  ("users", USER_COLUMNS, store.export_users(guild_id, chunk_size))):
+        path = os.path.join(directory, f"{guild_id}-{name}{writer_class.extension}")
+        writer = writer_class(path, columns)
+        try:
+            for chunk in chunks:
+                writer.write(chunk)
+                await asyncio.sleep(0) # let the bot get on with other things between chunks
+        finally:
+            writer.close()
+        paths.append(path)
+
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a server's posts and users' totals for analysis.")
+    parser.add_argument("guild_id", type=int)
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--storage", choices=("json", "sqlite"), default="json", help="which of the bot's stores to read")
+    parser.add_argument("--database", default="james.db", help="the database file, for sqlite storage")
+    parser.add_argument("--out", default=".", help="directory to write the files to")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="rows read and written at a time")
+    args = parser.parse_args()
+
+    # run from the bot's directory, so the JSON store finds its files
+    from storage import JsonStore, SqliteStore
+    store = SqliteStore(args.database) if args.storage == "sqlite" else JsonStore()
+
+    os.makedirs(args.out, exist_ok=True)
+    try:
+        paths = asyncio.run(export_guild(store, args.guild_id, args.out, args.format, args.chunk_size))
+    except ImportError:
+        sys.exit("Parquet exports need pyarrow: pip install pyarrow")
+
+    for path in paths:
+        print(f"Wrote {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import asyncio
+import itertools
+import random
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+import discord
+
+from outbound import REPLY
+from storage import DISCORD_EPOCH
+
+# a pretend Discord for bench.py: servers, members, channels and messages that live in memory, with API
+# calls that take a set time and are rate limited per route the way Discord's are. every call is
+# counted, so the benchmarks can say how many requests each operation costs. only as much of
+# discord.py is imitated as the bot actually uses
+
+
+# Discord-style IDs for things made now, so the times worked out from them make sense
+new_ids = itertools.count()
+
+def new_snowflake():
+    return (int(time.time() * 1000) - DISCORD_EPOCH) << 22 | (next(new_ids) & 0x3fffff)
+
+
+class FakeDiscord:
+    def __init__(self, latency=0.05, rate_limit=5, seed=0):
+        self.latency = latency # seconds each API call takes
+        self.rate_limit = rate_limit # calls per second allowed on each route bucket
+        self.random = random.Random(seed)
+        self.calls = Counter() # route -> number of calls
+        self.bucket_free = {} # bucket -> time.monotonic() its next call is allowed
+        self.guilds = {}
+        self.channels = {}
+        self.bot = None
+        self.user = FakeMember(self, new_snowflake(), "james")
+
+    # wait for the route's rate limit and the latency, counting the call
+    async def call(self, route, bucket):
+        self.calls[route] += 1
+
+        now = time.monotonic()
+        free = max(self.bucket_free.get(bucket, now), now)
+        self.bucket_free[bucket] = free + 1 / self.rate_limit
+
+        await asyncio.sleep(free - now + self.latency)
+
+    # make the bot use this instead of a real connection
+    def attach(self, bot):
+        self.bot = bot
+        bot._connection.user = self.user
+        bot.get_channel = self.channels.get
+        bot.get_guild = self.guilds.get
+        bot.fetch_channel = self.fetch_channel
+
+    async def fetch_channel(self, channel_id):
+        await self.call("fetch_channel", ("channels", channel_id))
+        return self.channels[channel_id]
+
+    # a server with `members` members and an image channel. only `cached` of the members are in the
+    # pretend gateway cache, the rest have to be looked up
+    def add_guild(self, members, cached=0.5):
+        guild = FakeGuild(self, new_snowflake(), f"Server {len(self.guilds) + 1}")
+        for number in range(members):
+            member = FakeMember(self, new_snowflake(), f"member{number}", discord.Colour(self.random.randrange(0x1000000)))
+            guild.members[member.id] = member
+            if self.random.random() < cached:
+                guild.cached.add(member.id)
+
+        channel = FakeChannel(self, new_snowflake(), guild)
+        guild.image_channel = channel
+        self.guilds[guild.id] = guild
+        self.channels[channel.id] = channel
+        return guild
+
+    # let the bot know about a reaction, like the gateway would
+    def dispatch_reaction(self, event, message, user_id, emoji):
+        payload = SimpleNamespace(message_id=message.id, channel_id=message.channel.id, guild_id=message.guild.id,
+                                  user_id=user_id, emoji=discord.PartialEmoji(name=emoji))
+        return getattr(self.bot, event)(payload)
+
+
+class FakeMember:
+    def __init__(self, backend, id, name, colour=discord.Colour.default()):
+        self.backend = backend
+        self.id = id
+        self.name = name
+        self.nick = None
+        self.display_name = name
+        self.mention = f"<@{id}>"
+        self.colour = colour
+        self.bot = False
+
+
+class FakeGuild:
+    def __init__(self, backend, id, name):
+        self.backend = backend
+        self.id = id
+        self.name = name
+        self.icon_url = ""
+        self.members = {} # every member
+        self.cached = set() # IDs of the members get_member knows about
+        self.image_channel = None
+
+    def get_member(self, user_id):
+        return self.members.get(user_id) if user_id in self.cached else None
+
+    async def query_members(self, user_ids, limit, cache):
+        await self.backend.call("query_members", ("gateway", self.id))
+        return [self.members[user_id] for user_id in user_ids if user_id in self.members][:limit]
+
+    async def fetch_member(self, user_id):
+        await self.backend.call("fetch_member", ("members", self.id))
+        if user_id not in self.members:
+            raise discord.errors.NotFound(SimpleNamespace(status=404, reason="Not Found"), "Unknown Member")
+        return self.members[user_id]
+
+
+class FakeChannel:
+    def __init__(self, backend, id, guild):
+        self.backend = backend
+        self.id = id
+        self.guild = guild
+        self.messages = {}
+
+    # a post by `author` with reactions {emoji: count}, including the bot's own (like a seeded post)
+    def add_post(self, author, votes):
+        message = FakeMessage(self, new_snowflake(), author)
+        message.reactions = [FakeReaction(emoji, count + 1, True) for emoji, count in votes.items()]
+        self.messages[message.id] = message
+        return message
+
+    # the bot passes message IDs as strings or ints, like discord.py accepts
+    async def fetch_message(self, message_id):
+        await self.backend.call("fetch_message", ("channels", self.id))
+        message_id = int(message_id)
+        if message_id not in self.messages:
+            raise discord.errors.NotFound(SimpleNamespace(status=404, reason="Not Found"), "Unknown Message")
+        return self.messages[message_id]
+
+    def get_partial_message(self, message_id):
+        message_id = int(message_id)
+        return self.messages.get(message_id) or FakeMessage(self, message_id, None)
+
+    async def send(self, content=None, **kwargs):
+        await self.backend.call("send_message", ("messages", self.id))
+        return FakeMessage(self, new_snowflake(), self.backend.user)
+
+
+class FakeReaction:
+    def __init__(self, emoji, count, me):
+        self.emoji = emoji
+        self.count = count
+        self.me = me
+
+
+class FakeMessage:
+    def __init__(self, channel, id, author):
+        self.channel = channel
+        self.guild = channel.guild
+        self.id = id
+        self.author = author
+        self.attachments = [SimpleNamespace(url=f"https://example.com/{id}.png")]
+        self.reactions = []
+
+    async def add_reaction(self, emoji):
+        await self.channel.backend.call("add_reaction", ("reactions", self.channel.id))
+
+    # like Discord, taking a reaction off sends a remove event back
+    async def remove_reaction(self, emoji, member):
+        backend = self.channel.backend
+        await backend.call("remove_reaction", ("reactions", self.channel.id))
+        await backend.dispatch_reaction("on_raw_reaction_remove", self, member.id, str(emoji))
+
+    async def edit(self, **kwargs):
+        await self.channel.backend.call("edit_message", ("messages", self.channel.id))
+
+
+# stands in for a command's context. replies go through the bot's outbound queue like QueuedContext's
+class FakeContext:
+    def __init__(self, bot, guild, author):
+        self.bot = bot
+        self.guild = guild
+        self.author = author
+        self.channel = guild.image_channel
+        self.message = SimpleNamespace(guild=guild, author=author, channel=self.channel)
+
+    async def send(self, content=None, **kwargs):
+        return await self.bot.outbound.submit(REPLY, ("messages", self.channel.id), lambda: self.channel.send(content, **kwargs))
@@ -0,0 +1,174 @@
+import numpy as np
+
+
+# a server's finished posts stored as columns, one row per post: post number, user index, score and the
+# time it was posted (0 if unknown). this is a few bytes per post however many members the server has,
+# and whole score curves can be worked out with a handful of numpy operations
+class ScoreHistory:
+    def __init__(self, capacity=64):
+        self.users = [] # user index -> user id
+        self.user_index = {} # user id -> user index
+        self.size = 0
+        self.total_posts = 0
+
+        self.post_nums = np.zeros(capacity, np.int64)
+        self.user_idx  = np.zeros(capacity, np.int32)
+        self.scores    = np.zeros(capacity, np.int64)
+        self.times     = np.zeros(capacity, np.float64)
+
+    # build from one array per column, in any order
+    @classmethod
+    def from_columns(cls, user_ids, image_scores, post_nums, times, total_posts):
+        order = np.argsort(post_nums, kind="stable")
+        users, user_idx = np.unique(user_ids[order], return_inverse=True)
+
+        size = len(order)
+        history = cls(capacity=max(size, 64))
+        history.users = users.tolist()
+        history.user_index = {user_id: index for index, user_id in enumerate(history.users)}
+        history.size = size
+        history.total_posts = total_posts
+
+        history.post_nums[:size] = post_nums[order]
+        history.user_idx[:size]  = user_idx
+        history.scores[:size]    = image_scores[order]
+        history.times[:size]     = times[order]
+
+        return history
+
+    def append(self, user_id, image_score, post_num, posted):
+        # grow the columns by doubling, so appending is cheap on average
+        if self.size == len(self.post_nums):
+            capacity = 2 * len(self.post_nums)
+            for name in ("post_nums", "user_idx", "scores", "times"):
+                column = getattr(self, name)
+                grown = np.zeros(capacity, column.dtype)
+                grown[:self.size] = column
+                setattr(self, name, grown)
+
+        index = self.user_index.get(user_id)
+        if index is None:
+            index = self.user_index[user_id] = len(self.users)
+            self.users.append(user_id)
+
+        self.post_nums[self.size] = post_num
+        self.user_idx[self.size]  = index
+        self.scores[self.size]    = image_score
+        self.times[self.size]     = posted
+        self.size += 1
+        self.total_posts = max(self.total_posts, post_num)
+
+    # {user id: (post numbers, running totals)} step curves of each user's score over time, from the post
+    # before the range to the last post in it. only the posts each user made are included, so drawing
+    # them as steps gives the full curve without a point for every post on the server. `user_ids` picks
+    # which users to include, and `since`/`until` (unix times) and `last` (a number of the server's most
+    # recent posts) limit the posts shown; scores from before the range still count towards where each
+    # curve starts
+    def curves(self, user_ids=None, since=None, until=None, last=None):
+        post_nums, user_idx = self.post_nums[:self.size], self.user_idx[:self.size]
+        scores, times = self.scores[:self.size], self.times[:self.size]
+        num_users = len(self.users)
+
+        selected = np.zeros(num_users, bool)
+        if user_ids is None:
+            selected[:] = True
+        else:
+            selected[[self.user_index[user_id] for user_id in user_ids if user_id in self.user_index]] = True
+
+        # split the posts into those before the range and those in it
+        before = times < since if since is not None else np.zeros(self.size, bool)
+        if last is not None:
+            before |= post_nums <= self.total_posts - last
+        in_range = ~before
+        if until is not None:
+            in_range &= times < until
+
+        if not in_range.any():
+            return {}
+
+        carried = np.bincount(user_idx[before], weights=scores[before], minlength=num_users).astype(np.int64)
+        present = selected & (np.bincount(user_idx[before | in_range], minlength=num_users) > 0)
+
+        if since is None and until is None and last is None:
+            first_post, last_post = 0, self.total_posts
+        else:
+            first_post, last_post = post_nums[in_range].min() - 1, post_nums[in_range].max()
+
+        # grouped cumulative sum: sort the posts by user then post number, take one running total over
+        # everything, then take off the total each user's group started from
+        keep = in_range & selected[user_idx]
+        order = np.lexsort((post_nums[keep], user_idx[keep]))
+        group_posts, group_users, group_scores = post_nums[keep][order], user_idx[keep][order], scores[keep][order]
+
+        running = np.cumsum(group_scores)
+        starts = np.flatnonzero(np.r_[True, group_users[1:] != group_users[:-1]]) if len(group_users) else np.zeros(0, np.int64)
+        lengths = np.diff(np.r_[starts, len(group_users)])
+        totals = running - np.repeat(running[starts] - group_scores[starts], lengths) + carried[group_users]
+
+        curves = {}
+        for start, length in zip(starts, lengths):
+            index = group_users[start]
+            x = np.r_[first_post, group_posts[start:start+length], last_post]
+            y = np.r_[carried[index], totals[start:start+length], totals[start+length-1]]
+            curves[self.users[index]] = (x, y)
+
+        # users who only posted before the range get a flat line
+        for index in np.flatnonzero(present):
+            user_id = self.users[index]
+            if user_id not in curves:
+                curves[user_id] = (np.array([first_post, last_post]), np.array([carried[index], carried[index]]))
+
+        return curves
+
+
+# indices of at most `budget` points of the line through (x, y) that keep its shape, picked with
+# Largest-Triangle-Three-Buckets: the first and last points are kept, the rest are split into equal
+# buckets, and from each bucket the point making the biggest triangle with the point picked from the
+# bucket before and the average of the bucket after is kept. lines with a few thousand points can then
+# be drawn with about one point per pixel, which looks the same and is much quicker to draw
+def downsample(x, y, budget):
+    if len(x) <= budget or budget < 3:
+        return np.arange(len(x))
+
+    x, y = np.asarray(x, np.float64), np.asarray(y, np.float64)
+    edges = np.linspace(1, len(x) - 1, budget - 1).astype(np.int64)
+    picked = np.zeros(budget, np.int64)
+    picked[-1] = len(x) - 1
+
+    for bucket in range(budget - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) else len(x)
+        next_x, next_y = x[end:next_end].mean(), y[end:next_end].mean()
+        previous = picked[bucket]
+
+        # twice each triangle's area, which is just as good for finding the biggest
+        areas = np.abs((x[previous] - next_x) * (y[start:end] - y[previous]) - (x[previous] - x[start:end]) * (next_y - y[previous]))
+        picked[bucket + 1] = start + np.argmax(areas)
+
+    return picked
+
+
+# count, mean and the given percentiles (0-100, interpolated the same way as np.percentile) of a
+# {score: number of posts} histogram. works on the distinct scores only, so it doesn't matter how many
+# posts went into the histogram
+def histogram_stats(histogram, percentiles=(25, 50, 75)):
+    if not histogram:
+        return None
+
+    scores = np.array(sorted(histogram), np.float64)
+    counts = np.array([histogram[score] for score in sorted(histogram)], np.int64)
+    cumulative = np.cumsum(counts)
+    count = int(cumulative[-1])
+
+    # the score at sorted position i (counting from 0) is the first one whose cumulative count passes i
+    def nth(i):
+        return scores[np.searchsorted(cumulative, i, side="right")]
+
+    stats = {"count": count, "mean": float(np.dot(scores, counts) / count)}
+    for percentile in percentiles:
+        position = (count - 1) * percentile / 100
+        lower = int(np.floor(position))
+        upper = min(lower + 1, count - 1)
+        stats[percentile] = float(nth(lower) + (nth(upper) - nth(lower)) * (position - lower))
+
+    return stats
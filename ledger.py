@@ -0,0 +1,60 @@
+import numpy as np
+
+
+# the raw votes on a server's finished posts, as a matrix with a row of emoji counts per post. scores
+# under any key are then a single matrix-vector product, so a server's whole history can be scored again
+# after its key changes without fetching anything from Discord
+class VoteLedger:
+    def __init__(self, post_nums, message_ids, channel_ids, emojis, counts):
+        self.post_nums = post_nums # post number of each row
+        self.message_ids = message_ids
+        self.channel_ids = channel_ids
+        self.emojis = emojis # emoji for each column
+        self.counts = counts # rows x emojis votes
+
+    def __len__(self):
+        return len(self.post_nums)
+
+    # build from (post number, message id, channel id, {emoji: votes}) for each post
+    @classmethod
+    def from_rows(cls, rows):
+        rows = list(rows)
+        emojis = sorted({emoji for *_, votes in rows for emoji in votes})
+        emoji_index = {emoji: index for index, emoji in enumerate(emojis)}
+
+        counts = np.zeros((len(rows), len(emojis)), np.int64)
+        for row, (*_, votes) in enumerate(rows):
+            for emoji, count in votes.items():
+                counts[row, emoji_index[emoji]] = count
+
+        return cls(np.array([row[0] for row in rows], np.int64),
+                   [row[1] for row in rows],
+                   [row[2] for row in rows],
+                   emojis, counts)
+
+    # every post's score under `key` ({emoji: points}), in row order
+    def scores(self, key):
+        weights = np.array([key.get(emoji, 0) for emoji in self.emojis], np.int64)
+        return self.counts @ weights
+
+
+
+# the best and worst of a server's posts, given every post's current score, message ID and channel ID (0
+# for posts from before those were kept). records are (message id, channel id, score). posts that can be
+# linked to win ties, and an old record with the right score stands in for a post that can't, since it's
+# most likely that post. otherwise the record has no message (0)
+def post_records(scores, message_ids, channel_ids, old_records=None):
+    known = set(message_ids[message_ids != 0].tolist())
+    records = {}
+    for name, score in (("best", scores.max()), ("worst", scores.min())):
+        tied = np.flatnonzero(scores == score)
+        linked = tied[message_ids[tied] != 0]
+        index = linked[0] if len(linked) else tied[0]
+        records[name] = (int(message_ids[index]), int(channel_ids[index]), int(score))
+
+        if not records[name][0] and old_records is not None:
+            old_record = tuple(old_records[name])
+            if old_record[2] == score and old_record[0] not in known:
+                records[name] = old_record
+
+    return records
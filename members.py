@@ -0,0 +1,74 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+import discord
+
+
+# remembers which users are (or aren't) in a server, so commands that show lots of users don't have to
+# fetch each one from Discord every time. members the gateway already has cached are used as they are;
+# the rest are looked up in bulk, and users who have left are remembered too so they aren't looked up
+# again on every call
+class MemberCache:
+    def __init__(self, ttl=600, max_size=10000, fetch_limit=10):
+        self.ttl = ttl # seconds before a cached lookup is done again
+        self.max_size = max_size # least recently used lookups are forgotten past this many
+        self.fetch_slots = asyncio.Semaphore(fetch_limit) # single fetches allowed at once if bulk queries fail
+        self.entries = OrderedDict() # (guild id, user id) -> (expiry time, member, or None if they've left)
+
+    # {user id: member, or None if they're no longer in the server} for all the given users
+    async def resolve(self, guild, user_ids):
+        members, missing = {}, []
+        now = time.time()
+
+        for user_id in user_ids:
+            member = guild.get_member(user_id)
+            if member is not None:
+                members[user_id] = member
+                continue
+
+            entry = self.entries.get((guild.id, user_id))
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end((guild.id, user_id))
+                members[user_id] = entry[1]
+            else:
+                missing.append(user_id)
+
+        if missing:
+            # gateway member queries take up to 100 users at a time, so send them all at once
+            chunks = [missing[i:i+100] for i in range(0, len(missing), 100)]
+            for found in await asyncio.gather(*(self.query(guild, chunk) for chunk in chunks)):
+                members.update(found)
+
+            for user_id in missing:
+                self.put(guild.id, user_id, members.get(user_id))
+                members.setdefault(user_id, None)
+
+        return members
+
+    async def query(self, guild, user_ids):
+        try:
+            found = await guild.query_members(user_ids=user_ids, limit=len(user_ids), cache=False)
+            return {member.id: member for member in found}
+        except (asyncio.TimeoutError, discord.errors.ClientException):
+            # fall back to fetching them one by one over the REST API, a few at a time
+            found = await asyncio.gather(*(self.fetch(guild, user_id) for user_id in user_ids))
+            return {member.id: member for member in found if member is not None}
+
+    async def fetch(self, guild, user_id):
+        async with self.fetch_slots:
+            try:
+                return await guild.fetch_member(user_id)
+            except discord.errors.NotFound:
+                return None
+
+    def put(self, guild_id, user_id, member):
+        self.entries[(guild_id, user_id)] = (time.time() + self.ttl, member)
+        self.entries.move_to_end((guild_id, user_id))
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    # forget a user, e.g. when they join or leave so the next lookup is fresh
+    def forget(self, guild_id, user_id):
+        self.entries.pop((guild_id, user_id), None)
@@ -0,0 +1,156 @@
+import asyncio
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from aiohttp import web
+
+# upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+# what each of the bot's metrics means
+HELP = {
+    "james_command_seconds": "Time taken to run each command.",
+    "james_event_seconds": "Time taken by each Discord event handler.",
+    "james_finalize_seconds": "Time taken to fetch, score and record each batch of finished posts.",
+    "james_finalize_backlog": "Finished posts waiting to be scored and recorded.",
+    "james_open_posts": "Posts open for voting.",
+    "james_posts_finished_total": "Posts scored and recorded.",
+    "james_save_seconds": "Time taken writing scores and settings to disk.",
+    "james_rest_requests_total": "Requests made to Discord's REST API.",
+    "james_rest_seconds": "Time taken by requests to Discord's REST API, including waiting for rate limits.",
+    "james_outbound_waiting": "Queued requests waiting to be sent, by priority.",
+    "james_event_loop_lag_seconds": "How late the event loop was to wake up from a short sleep.",
+    "james_event_loop_lag_last_seconds": "The most recent event loop lag measurement.",
+}
+
+
+# label values as Prometheus wants them quoted
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# how many observations fell into each bucket, plus their count and total, like a Prometheus histogram
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1) # the last bucket is everything over the biggest bound
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # roughly the value `fraction` of the way through the observations (the bound of its bucket)
+    def quantile(self, fraction):
+        seen = 0
+        for bound, count in zip(BUCKETS + (float("inf"),), self.counts):
+            seen += count
+            if seen >= fraction * self.count:
+                return bound
+        return float("inf")
+
+
+# the bot's counters, gauges and latency histograms. each is a name plus labels, e.g.
+# ("james_command_seconds", (("command", "graph"),)). kept cheap enough to record on every event
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {} # values, or functions called whenever the gauge is read
+        self.histograms = {}
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    # time the body of a with statement into a histogram
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    # {labels: histogram} for every histogram called `name`
+    def histograms_named(self, name):
+        return {labels: histogram for (histogram_name, labels), histogram in self.histograms.items() if histogram_name == name}
+
+    def counters_named(self, name):
+        return {labels: value for (counter_name, labels), value in self.counters.items() if counter_name == name}
+
+    # everything in the Prometheus text format
+    def render(self):
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in HELP:
+                    lines.append(f"# HELP {name} {HELP[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        def label_text(labels, extra=()):
+            labels = tuple(labels) + tuple(extra)
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
+
+        for (name, labels), value in sorted(self.counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{label_text(labels)} {value}")
+
+        for (name, labels), value in sorted(self.gauges.items(), key=lambda item: item[0]):
+            header(name, "gauge")
+            lines.append(f"{name}{label_text(labels)} {value() if callable(value) else value}")
+
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{label_text(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{label_text(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{label_text(labels)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+    # measure how late the event loop is to wake up from a short sleep. anything blocking the loop (slow
+    # handlers, big JSON dumps) shows up here
+    async def probe_loop_lag(self, interval=0.5):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            lag = max(time.perf_counter() - started - interval, 0)
+            self.observe("james_event_loop_lag_seconds", lag)
+            self.set("james_event_loop_lag_last_seconds", lag)
+
+    # serve the metrics at http://<host>:<port>/metrics for Prometheus to scrape
+    async def serve(self, host, port):
+        async def handle(request):
+            return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+# shared by everything in the bot, so modules can record metrics without having the bot to hand
+registry = Metrics()
@@ -0,0 +1,176 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from discord.ext import commands
+
+# priorities, most urgent first
+REPLY = 0 # answers to commands
+SEED = 1 # voting reactions on new posts
+CLEANUP = 2 # taking back votes and clocks
+
+PRIORITY_NAMES = {REPLY: "replies", SEED: "seeding", CLEANUP: "cleanup"}
+
+
+class Action:
+    def __init__(self, priority, bucket, make, key, tag):
+        self.priority = priority
+        self.bucket = bucket
+        self.make = make # coroutine function that does the request
+        self.key = key # actions with the same key do the same thing, so only one is ever queued
+        self.tag = tag # e.g. the message the action is for, so everything for it can be dropped at once
+        self.future = asyncio.get_event_loop().create_future()
+        self.queued_at = time.monotonic()
+
+
+# every request the bot makes to Discord goes through here, so the important ones go first when there's a
+# lot going on. Discord rate limits each route (e.g. reactions in one channel) separately, so actions for
+# the same bucket run one at a time, in priority order, and a few buckets can run at once. an action that
+# repeats one already queued is merged with it, and queued actions that aren't needed any more (like
+# removing a vote that's already gone) can be dropped before they're sent. each bucket has its own heap
+# of waiting actions, and only buckets that are free to run one are looked at, so a burst of actions
+# for one bucket doesn't have to be gone through every time something finishes
+class ActionQueue:
+    def __init__(self, max_in_flight=4):
+        self.max_in_flight = max_in_flight # requests allowed to be running at once
+        self.in_flight = 0
+        self.waiting = {} # bucket -> heap of (priority, order queued, action)
+        # heap of (priority, order queued, bucket) for the most urgent action of each bucket that isn't
+        # busy. entries go out of date when that action is dropped or a more urgent one is queued, and
+        # are checked when they reach the front
+        self.ready = []
+        self.order = itertools.count()
+        self.busy_buckets = set()
+        self.queued = {} # key -> action, for queued actions that have a key
+
+        # priority -> [actions done, total seconds waited, longest wait], plus counts of actions
+        # merged into others and dropped
+        self.waits = {priority: [0, 0.0, 0.0] for priority in PRIORITY_NAMES}
+        self.merged = 0
+        self.dropped = 0
+
+    # queue `make` (a coroutine function) and return a future for its result. if an action with the same
+    # key is already queued, its future is returned instead
+    def submit(self, priority, bucket, make, key=None, tag=None):
+        if key is not None and key in self.queued:
+            self.merged += 1
+            return self.queued[key].future
+
+        action = Action(priority, bucket, make, key, tag)
+        if key is not None:
+            self.queued[key] = action
+
+        entry = (priority, next(self.order), action)
+        waiting = self.waiting.setdefault(bucket, [])
+        heapq.heappush(waiting, entry)
+        if bucket not in self.busy_buckets and waiting[0] is entry:
+            heapq.heappush(self.ready, (priority, entry[1], bucket))
+
+        self.pump()
+        return action.future
+
+    # queue an action nobody waits for. failures are printed rather than raised
+    def post(self, priority, bucket, make, key=None, tag=None, description="request"):
+        def done(future):
+            if not future.cancelled() and future.exception() is not None:
+                print(f"Couldn't complete {description}: {future.exception()}. Continuing...")
+
+        self.submit(priority, bucket, make, key, tag).add_done_callback(done)
+
+    # drop the queued action with this key, if it hasn't started yet
+    def cancel(self, key):
+        action = self.queued.pop(key, None)
+        if action is not None:
+            self.drop_action(action)
+
+    # every action that's queued and hasn't been dropped
+    def waiting_actions(self):
+        for waiting in self.waiting.values():
+            for _, _, action in waiting:
+                if not action.future.done():
+                    yield action
+
+    # drop every queued action with this tag that hasn't started yet
+    def drop(self, tag):
+        for action in list(self.waiting_actions()):
+            if action.tag == tag:
+                if action.key is not None:
+                    self.queued.pop(action.key, None)
+                self.drop_action(action)
+
+    # dropped actions stay in the heap and are skipped when they reach the front
+    def drop_action(self, action):
+        self.dropped += 1
+        action.future.set_result(None)
+
+    # start as many waiting actions as there are free slots, most urgent first, from buckets that don't
+    # already have an action running
+    def pump(self):
+        while self.ready and self.in_flight < self.max_in_flight:
+            _, order, bucket = heapq.heappop(self.ready)
+            waiting = self.waiting.get(bucket)
+            if bucket in self.busy_buckets or waiting is None:
+                continue
+
+            while waiting and waiting[0][2].future.done():
+                heapq.heappop(waiting)
+            if not waiting:
+                del self.waiting[bucket]
+                continue
+
+            # the bucket's most urgent action has changed since this entry was made
+            if waiting[0][1] != order:
+                heapq.heappush(self.ready, (*waiting[0][:2], bucket))
+                continue
+
+            action = heapq.heappop(waiting)[2]
+            if not waiting:
+                del self.waiting[bucket]
+            if action.key is not None:
+                self.queued.pop(action.key, None)
+
+            self.in_flight += 1
+            self.busy_buckets.add(bucket)
+            asyncio.ensure_future(self.run(action))
+
+    async def run(self, action):
+        waited = time.monotonic() - action.queued_at
+        stats = self.waits[action.priority]
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+
+        try:
+            result = await action.make()
+        except Exception as error:
+            if not action.future.done():
+                action.future.set_exception(error)
+        else:
+            if not action.future.done():
+                action.future.set_result(result)
+        finally:
+            self.in_flight -= 1
+            self.busy_buckets.discard(action.bucket)
+            waiting = self.waiting.get(action.bucket)
+            if waiting:
+                heapq.heappush(self.ready, (*waiting[0][:2], action.bucket))
+            self.pump()
+
+    # {priority name: (actions waiting, actions done, average wait, longest wait)}
+    def stats(self):
+        depths = {priority: 0 for priority in PRIORITY_NAMES}
+        for action in self.waiting_actions():
+            depths[action.priority] += 1
+
+        return {name: (depths[priority], self.waits[priority][0],
+                       self.waits[priority][1] / self.waits[priority][0] if self.waits[priority][0] else 0.0,
+                       self.waits[priority][2])
+                for priority, name in PRIORITY_NAMES.items()}
+
+
+# command context whose replies go through the bot's ActionQueue at the highest priority
+class QueuedContext(commands.Context):
+    async def send(self, *args, **kwargs):
+        return await self.bot.outbound.submit(REPLY, ("messages", self.channel.id),
+                                              lambda: commands.Context.send(self, *args, **kwargs))
@@ -0,0 +1,45 @@
+from bisect import bisect_left, insort
+
+
+# a server's users in leaderboard order, kept sorted as scores change so the leaderboard never has to be
+# sorted again. ranks are found by binary search and pages are slices, so both stay fast however many
+# users there are. changing a score moves one entry in a flat list, which is cheap even for big servers
+class RankIndex:
+    def __init__(self, totals=()):
+        self.totals = {} # user id -> (score, submitted)
+        self.total_score = 0
+        self.total_submitted = 0
+
+        for user_id, score, submitted in totals:
+            self.totals[user_id] = (score, submitted)
+            self.total_score += score
+            self.total_submitted += submitted
+
+        # (-score, user id), so the best score comes first and ties are broken the same way every time
+        self.order = sorted((-score, user_id) for user_id, (score, _) in self.totals.items())
+
+    def __len__(self):
+        return len(self.order)
+
+    # count a finished post towards its author's total
+    def add_post(self, user_id, score):
+        old_score, old_submitted = self.totals.get(user_id, (0, 0))
+        if user_id in self.totals:
+            del self.order[bisect_left(self.order, (-old_score, user_id))]
+
+        self.totals[user_id] = (old_score + score, old_submitted + 1)
+        insort(self.order, (-(old_score + score), user_id))
+
+        self.total_score += score
+        self.total_submitted += 1
+
+    # the user's position on the leaderboard (starting at 1), or None if they haven't posted
+    def rank(self, user_id):
+        if user_id not in self.totals:
+            return None
+
+        return bisect_left(self.order, (-self.totals[user_id][0], user_id)) + 1
+
+    # list of (user id, score, submitted) for `count` users, starting from the given rank
+    def page(self, start_rank, count):
+        return [(user_id, *self.totals[user_id]) for _, user_id in self.order[start_rank-1:start_rank-1+count]]
@@ -0,0 +1,192 @@
+import asyncio
+import io
+import os
+import time
+from functools import lru_cache
+from itertools import combinations
+
+import aiohttp
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+
+# what's stored for each post in a server's hash file: its image hash, message ID and channel ID
+RECORD = np.dtype([("hash", "<u8"), ("message_id", "<u8"), ("channel_id", "<u8")])
+
+CHUNKS = 4 # hashes are split into this many 16 bit pieces for the index
+CHUNK_BITS = 64 // CHUNKS
+
+
+# DCT-II matrix for 32x32 images, so the transform is two matrix products. it's unnormalised like
+# scipy's default (the one imagehash uses), since normalising scales the first row differently and
+# changes which frequencies end up above the median
+def dct_matrix(size=32):
+    n = np.arange(size)
+    return 2 * np.cos(np.pi / size * (n[None, :] + 0.5) * n[:, None])
+
+DCT = dct_matrix()
+
+
+# perceptual hash of an image (the bytes of the file), the same way imagehash.phash does it: shrink it
+# to 32x32 greyscale, take the lowest 8x8 frequencies of its DCT and set a bit for each one above their
+# median. resizing, recompressing or slightly editing an image changes only a few bits
+def phash(data):
+    with Image.open(io.BytesIO(data)) as image:
+        pixels = np.asarray(image.convert("L").resize((32, 32), Image.LANCZOS), np.float64)
+
+    low = (DCT @ pixels @ DCT.T)[:8, :8]
+    bits = (low > np.median(low)).flatten()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+# every 16 bit value within `radius` bits of 0, to be XORed with a chunk to get its neighbours
+@lru_cache()
+def flip_masks(radius):
+    masks = [0]
+    for flips in range(1, radius + 1):
+        for bits in combinations(range(CHUNK_BITS), flips):
+            masks.append(sum(1 << bit for bit in bits))
+    return np.array(masks, np.uint16)
+
+
+# one server's image hashes, searchable by Hamming distance with multi-index hashing: each hash is split
+# into 4 chunks, and two hashes within r bits of each other must have some chunk within r // 4 bits, so
+# only hashes sharing a nearby chunk have to be compared. each chunk has a sorted copy of the hashes'
+# values for it to binary search; hashes added since the last sort are kept in a short list that's just
+# compared with everything
+class HashIndex:
+    def __init__(self, records, merge_every=1024):
+        self.merge_every = merge_every # unsorted hashes allowed before they're merged into the sorted ones
+        self.records = records # sorted part, an array of RECORD
+        self.recent = [] # (hash, message ID, channel ID) added since the last merge
+        self.sort()
+
+    def __len__(self):
+        return len(self.records) + len(self.recent)
+
+    def sort(self):
+        if self.recent:
+            self.records = np.concatenate([self.records, np.array(self.recent, RECORD)])
+            self.recent = []
+
+        # per chunk: the order that sorts the hashes by that chunk, and the chunk values in that order
+        self.orders, self.keys = [], []
+        for chunk in range(CHUNKS):
+            values = (self.records["hash"] >> np.uint64(chunk * CHUNK_BITS)).astype(np.uint16)
+            order = np.argsort(values, kind="stable")
+            self.orders.append(order)
+            self.keys.append(values[order])
+
+    def add(self, hash, message_id, channel_id):
+        self.recent.append((hash, message_id, channel_id))
+        if len(self.recent) >= self.merge_every:
+            self.sort()
+
+    # [(distance, message ID, channel ID)] of every hash within `distance` bits of `hash`, closest first
+    def search(self, hash, distance):
+        masks = flip_masks(distance // CHUNKS)
+        candidates = []
+
+        for chunk in range(CHUNKS):
+            probes = np.uint16((hash >> (chunk * CHUNK_BITS)) & 0xffff) ^ masks
+            starts = np.searchsorted(self.keys[chunk], probes, "left")
+            ends = np.searchsorted(self.keys[chunk], probes, "right")
+            for start, end in zip(starts[starts < ends], ends[starts < ends]):
+                candidates.append(self.orders[chunk][start:end])
+
+        matches = []
+        if candidates:
+            found = self.records[np.unique(np.concatenate(candidates))]
+            distances = np.bitwise_count(found["hash"] ^ np.uint64(hash))
+            close = distances <= distance
+            matches.extend(zip(distances[close].tolist(), found["message_id"][close].tolist(), found["channel_id"][close].tolist()))
+
+        for recent_hash, message_id, channel_id in self.recent:
+            recent_distance = (recent_hash ^ hash).bit_count()
+            if recent_distance <= distance:
+                matches.append((recent_distance, message_id, channel_id))
+
+        return sorted(matches)
+
+    def message_ids(self):
+        return set(self.records["message_id"].tolist()) | {record[1] for record in self.recent}
+
+
+# spots posts that repeat an image already posted in the server. attachments are downloaded through one
+# shared connection pool and hashed in a thread, and each server's hashes are kept in their own file that
+# new ones are appended to, only read the first time the server posts an image. servers that haven't
+# posted for a while are dropped from memory
+class RepostFinder:
+    def __init__(self, directory="hashes", max_size=8*1024*1024, download_limit=4):
+        self.directory = directory
+        self.max_size = max_size # attachments bigger than this many bytes aren't checked
+        self.download_limit = download_limit # attachments downloaded at once
+        self.session = None
+        self.indexes = {} # server ID -> HashIndex
+        self.last_used = {} # server ID -> time.monotonic() when its index was last used
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, guild_id):
+        return os.path.join(self.directory, f"{guild_id}.bin")
+
+    def index(self, guild_id):
+        self.last_used[guild_id] = time.monotonic()
+        index = self.indexes.get(guild_id)
+        if index is None:
+            try:
+                records = np.fromfile(self.path(guild_id), RECORD)
+            except FileNotFoundError:
+                records = np.zeros(0, RECORD)
+            index = self.indexes[guild_id] = HashIndex(records)
+
+        return index
+
+    # the hash of an attachment, or None if it can't be downloaded or isn't an image
+    async def hash_attachment(self, attachment):
+        if attachment.size > self.max_size:
+            return None
+
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.download_limit),
+                                                 timeout=aiohttp.ClientTimeout(total=30))
+
+        try:
+            async with self.session.get(attachment.url) as response:
+                response.raise_for_status()
+                data = await response.read()
+            return await asyncio.get_event_loop().run_in_executor(None, phash, data)
+        except (aiohttp.ClientError, asyncio.TimeoutError, UnidentifiedImageError, OSError, ValueError) as error:
+            print(f"Couldn't hash {attachment.url}: {error}. Continuing...")
+            return None
+
+    # (distance, message ID, channel ID) of the closest earlier post within `distance` bits of this hash
+    def find(self, guild_id, hash, distance):
+        matches = self.index(guild_id).search(hash, distance)
+        return matches[0] if matches else None
+
+    def add(self, guild_id, hash, message_id, channel_id):
+        index = self.index(guild_id)
+        index.add(hash, message_id, channel_id)
+        with open(self.path(guild_id), "ab") as f:
+            f.write(np.array([(hash, message_id, channel_id)], RECORD).tobytes())
+
+    # hash a post's first attachment and add it. returns (hash, closest earlier post within `distance`
+    # bits, or None), or None if the attachment couldn't be hashed
+    async def check(self, message, distance):
+        hash = await self.hash_attachment(message.attachments[0])
+        if hash is None:
+            return None
+
+        match = self.find(message.guild.id, hash, distance)
+        self.add(message.guild.id, hash, message.id, message.channel.id)
+        return hash, match
+
+    def evict_idle(self, idle_time):
+        now = time.monotonic()
+        for guild_id, last_used in list(self.last_used.items()):
+            if now - last_used > idle_time:
+                self.indexes.pop(guild_id, None)
+                del self.last_used[guild_id]
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
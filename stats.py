@@ -0,0 +1,311 @@
+import argparse
+import json
+
+import numpy as np
+
+from storage import new_records
+
+# a server's scores in memory, and the binary snapshot files they're saved in. a snapshot is:
+#
+#   8 bytes   SNAPSHOT_MAGIC
+#   8 bytes   length of the header (little-endian)
+#   header    JSON: the server's small values, plus the dtype, shape and offset of each array
+#   arrays    each array's raw bytes, starting on a multiple of 8 bytes
+#
+# so the post columns can be memory-mapped straight out of the file rather than read and parsed. the
+# JSON format (see JsonStore) can still be converted to and from with from_json() and to_json(), or
+# `python stats.py to-json <snapshot> <json>` and `python stats.py from-json <json> <snapshot> <server id>`
+
+SNAPSHOT_MAGIC = b"JAMESSN1"
+
+# one entry per post, in post number order
+POST_COLUMNS = {
+    "post_nums":   np.int64,
+    "user_ids":    np.int64,
+    "scores":      np.int64,
+    "times":       np.float64, # unix time posted, 0 if unknown
+    "message_ids": np.int64, # 0 if unknown
+    "channel_ids": np.int64, # 0 if unknown
+    "voted":       np.int8, # 1 if the post's votes are in `votes`
+}
+
+
+class UserStats:
+    __slots__ = ("score", "submitted", "distribution")
+
+    def __init__(self, score=0, submitted=0, distribution=None):
+        self.score = score
+        self.submitted = submitted
+        self.distribution = distribution if distribution is not None else {} # image score -> posts with that score
+
+
+# everything about one server's scores, with integer IDs throughout. users' totals and score
+# distributions are small and kept in UserStats; the posts are kept as columns of numbers, which take
+# under 100 bytes per post where the nested lists, dictionaries and strings took nearly 600. the columns
+# are grown by doubling as posts are added, and stay memory-mapped from the snapshot until then
+class GuildStats:
+    __slots__ = ("guild_id", "submitted", "records", "users", "distribution", "emojis", "size", "votes", *POST_COLUMNS)
+
+    def __init__(self, guild_id, submitted=0, records=None, capacity=64):
+        self.guild_id = guild_id
+        self.submitted = submitted # posts finished in the server
+        self.records = records # {"best"/"worst": (message id, channel id, score)}, or None if not worked out yet
+        self.users = {} # user id -> UserStats
+        self.distribution = {} # image score -> posts with that score, for the whole server
+        self.emojis = [] # column of `votes` for each emoji
+        self.size = 0 # posts in the columns
+
+        for name, dtype in POST_COLUMNS.items():
+            setattr(self, name, np.zeros(capacity, dtype))
+        self.votes = np.zeros((capacity, 0), np.int64) # posts x emojis
+
+    @classmethod
+    def new(cls, guild_id):
+        return cls(guild_id, records=new_records())
+
+    # make room for at least one more post. this also copies memory-mapped columns into memory
+    def grow(self):
+        if self.size < len(self.post_nums) and self.post_nums.flags.writeable:
+            return
+
+        capacity = max(2 * self.size, 64)
+        for name in (*POST_COLUMNS, "votes"):
+            column = getattr(self, name)
+            grown = np.zeros((capacity, *column.shape[1:]), column.dtype)
+            grown[:self.size] = column[:self.size]
+            setattr(self, name, grown)
+
+    def emoji_column(self, emoji):
+        if emoji not in self.emojis:
+            self.emojis.append(emoji)
+            self.votes = np.c_[self.votes, np.zeros(len(self.votes), np.int64)]
+        return self.emojis.index(emoji)
+
+    # add a finished post and return its post number
+    def add_post(self, author_id, message_id, channel_id, score, posted, votes=None):
+        self.grow()
+
+        post_num = self.submitted + 1
+        row = self.size
+        self.post_nums[row], self.user_ids[row], self.scores[row], self.times[row] = post_num, author_id, score, posted
+        self.message_ids[row], self.channel_ids[row], self.voted[row] = message_id, channel_id, 1 if votes else 0
+        for emoji, count in (votes or {}).items():
+            column = self.emoji_column(emoji)
+            self.votes[row, column] = count
+        self.size += 1
+        self.submitted = post_num
+
+        user = self.users.get(author_id)
+        if user is None:
+            user = self.users[author_id] = UserStats()
+        user.score += score
+        user.submitted += 1
+        for holder in (user.distribution, self.distribution):
+            holder[score] = holder.get(score, 0) + 1
+
+        # servers rebuilt by convert have no records yet
+        if self.records is None:
+            self.records = new_records()
+        if score < self.records["worst"][2]:
+            self.records["worst"] = (message_id, channel_id, score)
+        if score > self.records["best"][2]:
+            self.records["best"] = (message_id, channel_id, score)
+
+        return post_num
+
+    # (user id, score, submitted) for every user, for a RankIndex
+    def totals(self):
+        return ((user_id, user.score, user.submitted) for user_id, user in self.users.items())
+
+    def history(self):
+        from history import ScoreHistory
+
+        size = self.size
+        return ScoreHistory.from_columns(self.user_ids[:size], self.scores[:size], self.post_nums[:size], self.times[:size], self.submitted)
+
+    # count up the score distributions again from the posts
+    def rebuild_distributions(self):
+        self.distribution = {}
+        for user in self.users.values():
+            user.distribution = {}
+
+        for user_id, score in zip(self.user_ids[:self.size].tolist(), self.scores[:self.size].tolist()):
+            for holder in (self.users[user_id].distribution, self.distribution):
+                holder[score] = holder.get(score, 0) + 1
+
+    # the posts whose votes were recorded, as a VoteLedger
+    def ledger(self):
+        from ledger import VoteLedger
+
+        rows = np.flatnonzero(self.voted[:self.size])
+        return VoteLedger(self.post_nums[rows], self.message_ids[rows].tolist(), self.channel_ids[rows].tolist(),
+                          list(self.emojis), np.array(self.votes[rows]))
+
+    # score every post with recorded votes again under `key` and update everything built from the scores.
+    # returns how many posts were scored again
+    def rescore(self, key):
+        ledger = self.ledger()
+        if not len(ledger):
+            return 0
+
+        scores = ledger.scores(key)
+        self.grow()
+        rows = np.searchsorted(self.post_nums[:self.size], ledger.post_nums)
+        self.scores[rows] = scores
+
+        totals = {user_id: 0 for user_id in self.users}
+        for user_id, score in zip(self.user_ids[:self.size].tolist(), self.scores[:self.size].tolist()):
+            totals[user_id] += score
+        for user_id, total in totals.items():
+            self.users[user_id].score = total
+
+        from ledger import post_records
+        self.records = post_records(self.scores[:self.size], self.message_ids[:self.size], self.channel_ids[:self.size], self.records)
+        self.rebuild_distributions()
+        return len(ledger)
+
+    # build from the JSON format (see JsonStore)
+    @classmethod
+    def from_json(cls, guild_id, guild_scores):
+        posts = sorted((post[1], int(user_id), post[0], post[2] if len(post) > 2 else 0)
+                       for user_id, user_posts in guild_scores["graph"].items() for post in user_posts)
+        records = guild_scores.get("records")
+
+        stats = cls(guild_id, guild_scores["submitted"],
+                    {name: tuple(record) for name, record in records.items()} if records else None,
+                    capacity=max(len(posts), 64))
+
+        stats.size = len(posts)
+        if posts:
+            stats.post_nums[:stats.size], stats.user_ids[:stats.size], stats.scores[:stats.size], stats.times[:stats.size] = zip(*posts)
+
+        rows = {post_num: row for row, (post_num, *_) in enumerate(posts)}
+        for post_num, (message_id, channel_id, votes) in guild_scores.get("ledger", {}).items():
+            row = rows.get(int(post_num))
+            if row is None:
+                continue
+
+            stats.message_ids[row], stats.channel_ids[row], stats.voted[row] = message_id, channel_id, 1
+            for emoji, count in votes.items():
+                column = stats.emoji_column(emoji)
+                stats.votes[row, column] = count
+
+        for user_id, info in guild_scores["leaderboard"].items():
+            stats.users[int(user_id)] = UserStats(info["score"], info["submitted"],
+                                                  {int(score): posts for score, posts in info.get("distribution", {}).items()})
+
+        if "distribution" in guild_scores and all("distribution" in info for info in guild_scores["leaderboard"].values()):
+            stats.distribution = {int(score): posts for score, posts in guild_scores["distribution"].items()}
+        else:
+            stats.rebuild_distributions()
+
+        return stats
+
+    def to_json(self):
+        guild_scores = {"leaderboard": {}, "graph": {}, "submitted": self.submitted,
+                        "distribution": {str(score): posts for score, posts in self.distribution.items()}}
+        if self.records is not None:
+            guild_scores["records"] = {name: list(record) for name, record in self.records.items()}
+
+        for user_id, user in self.users.items():
+            guild_scores["leaderboard"][str(user_id)] = {"score": user.score, "submitted": user.submitted,
+                                                         "distribution": {str(score): posts for score, posts in user.distribution.items()}}
+            guild_scores["graph"][str(user_id)] = []
+
+        size = self.size
+        for user_id, score, post_num, posted in zip(self.user_ids[:size].tolist(), self.scores[:size].tolist(),
+                                                    self.post_nums[:size].tolist(), self.times[:size].tolist()):
+            guild_scores["graph"][str(user_id)].append([score, post_num, posted] if posted else [score, post_num])
+
+        ledger = guild_scores["ledger"] = {}
+        for row in np.flatnonzero(self.voted[:size]).tolist():
+            ledger[str(int(self.post_nums[row]))] = [int(self.message_ids[row]), int(self.channel_ids[row]),
+                                                     {emoji: int(count) for emoji, count in zip(self.emojis, self.votes[row].tolist()) if count}]
+
+        return guild_scores
+
+    # the snapshot file's contents
+    def to_bytes(self):
+        # users and distributions go in as arrays too
+        arrays = {name: getattr(self, name)[:self.size] for name in POST_COLUMNS}
+        arrays["votes"] = self.votes[:self.size]
+        arrays["users"] = np.array([(user_id, user.score, user.submitted) for user_id, user in self.users.items()], np.int64).reshape(-1, 3)
+        arrays["distribution"] = np.array(list(self.distribution.items()), np.int64).reshape(-1, 2)
+        arrays["user_distributions"] = np.array([(user_id, score, posts) for user_id, user in self.users.items()
+                                                 for score, posts in user.distribution.items()], np.int64).reshape(-1, 3)
+
+        header = {"guild_id": self.guild_id, "submitted": self.submitted, "records": self.records, "emojis": self.emojis, "arrays": {}}
+        offset = 0
+        for name, array in arrays.items():
+            header["arrays"][name] = [array.dtype.str, array.shape, offset]
+            offset += -(-array.nbytes // 8) * 8
+
+        # the arrays' offsets count from the end of the header, which is padded to a multiple of 8 bytes
+        header_bytes = json.dumps(header, separators=(',', ':')).encode()
+        header_bytes += b" " * (-len(header_bytes) % 8)
+
+        parts = [SNAPSHOT_MAGIC, len(header_bytes).to_bytes(8, "little"), header_bytes]
+        for array in arrays.values():
+            data = np.ascontiguousarray(array).tobytes()
+            parts.append(data + b"\0" * (-len(data) % 8))
+
+        return b"".join(parts)
+
+    # load a snapshot file. the post columns are memory-mapped read-only, and copied into memory the first
+    # time a post is added
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            if f.read(8) != SNAPSHOT_MAGIC:
+                raise ValueError(f"{path} isn't a scores snapshot")
+            header_length = int.from_bytes(f.read(8), "little")
+            header = json.loads(f.read(header_length))
+
+        start = 16 + header_length
+
+        def array(name):
+            dtype, shape, offset = header["arrays"][name]
+            if not np.prod(shape):
+                return np.zeros(shape, dtype)
+            return np.memmap(path, dtype, "r", start + offset, tuple(shape))
+
+        records = header["records"]
+        stats = cls(header["guild_id"], header["submitted"], {name: tuple(record) for name, record in records.items()} if records else None, capacity=0)
+        stats.emojis = header["emojis"]
+        for name in (*POST_COLUMNS, "votes"):
+            setattr(stats, name, array(name))
+        stats.size = len(stats.post_nums)
+
+        for user_id, score, submitted in array("users").tolist():
+            stats.users[user_id] = UserStats(score, submitted)
+        stats.distribution = dict(array("distribution").tolist())
+        for user_id, score, posts in array("user_distributions").tolist():
+            stats.users[user_id].distribution[score] = posts
+
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a server's scores between the JSON format and snapshots.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    to_json = commands.add_parser("to-json")
+    to_json.add_argument("snapshot")
+    to_json.add_argument("json")
+    from_json = commands.add_parser("from-json")
+    from_json.add_argument("json")
+    from_json.add_argument("snapshot")
+    from_json.add_argument("guild_id", type=int)
+    args = parser.parse_args()
+
+    if args.command == "to-json":
+        with open(args.json, "w") as f:
+            json.dump(GuildStats.load(args.snapshot).to_json(), f, separators=(',', ':'))
+    else:
+        with open(args.json) as f:
+            stats = GuildStats.from_json(args.guild_id, json.load(f))
+        with open(args.snapshot, "wb") as f:
+            f.write(stats.to_bytes())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,778 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+
+import aiofiles
+
+from metrics import registry
+from ranking import RankIndex
+
+# numpy (and everything that uses it, including servers' scores) is only imported once something needs
+# it, so the bot starts faster
+
+DISCORD_EPOCH = 1420070400000 # milliseconds since the unix epoch that Discord IDs count from
+
+# the kinds of per-server settings kept in the preferences, each a dictionary keyed by server ID string
+PREFERENCE_CATEGORIES = ("image_channels", "prefixes", "admins", "transparency", "timers", "keys")
+
+
+# the unix time a Discord message (or anything else with an ID) was created
+def snowflake_time(snowflake):
+    return ((int(snowflake) >> 22) + DISCORD_EPOCH) / 1000
+
+
+# the records a server starts with, before any post has beaten them
+def new_records():
+    return {"best": (0, 0, -1), "worst": (0, 0, 100000)}
+
+
+# keeps a JSON file in sync with an in-memory object. callers mark the object as changed with touch(),
+# and a single background task per file writes it out once changes have settled, so a burst of changes
+# becomes one write and two writes to the same file can never overlap
+class JsonWriter:
+    def __init__(self, data, file_path, delay, name=None):
+        self.data = data
+        self.file_path = file_path
+        self.name = name or os.path.basename(file_path) # what the file is called in the save time metrics
+        self.delay = delay # seconds to wait for more changes before writing
+        self.dirty = False
+        self.wake = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task = None
+
+    # mark the data as changed and make sure the writer task is running
+    def touch(self):
+        self.dirty = True
+        self.wake.set()
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            await self.wake.wait()
+            self.wake.clear()
+
+            # let any other changes in this burst pile up before writing
+            await asyncio.sleep(self.delay)
+            await self.flush()
+
+    # write the data out now if anything has changed since the last write
+    async def flush(self):
+        async with self.lock:
+            if not self.dirty:
+                return
+
+            with registry.timer("james_save_seconds", file=self.name):
+                # serialise before the first await so the snapshot can't change halfway through
+                self.dirty = False
+                contents = self.serialise()
+
+                # write to a temporary file and rename it over the old one, so the file on disk is
+                # always either the complete old version or the complete new one
+                temp_path = self.file_path + ".tmp"
+                try:
+                    async with aiofiles.open(temp_path, "wb" if isinstance(contents, bytes) else "w") as f:
+                        await f.write(contents)
+                        await f.flush()
+                        await asyncio.get_event_loop().run_in_executor(None, os.fsync, f.fileno())
+
+                    os.replace(temp_path, self.file_path)
+                except OSError as error:
+                    # leave it dirty so the next write tries again
+                    self.dirty = True
+                    print(f"Couldn't save {self.file_path}: {error}")
+
+    def serialise(self):
+        return json.dumps(self.data, separators=(',', ':'))
+
+
+# the same for a server's GuildStats, written as a binary snapshot
+class SnapshotWriter(JsonWriter):
+    def serialise(self):
+        return self.data.to_bytes()
+
+
+# servers' scores (GuildStats), each kept in its own snapshot file that's only read the first time the
+# server's scores are needed. used like a dictionary keyed by server ID string. servers that haven't been
+# used for a while are written out and dropped from memory by evict_idle(), so startup time and memory
+# use depend on how many servers are active rather than how many there are or how long their histories
+# are. servers still in the old per-server JSON files are converted the first time they're read; the JSON
+# file is left alone, but isn't read again once there's a snapshot
+class GuildShards:
+    def __init__(self, directory, save_delay=5):
+        self.directory = directory
+        self.save_delay = save_delay
+        self.loaded = {} # server ID string -> GuildStats
+        self.writers = {} # server ID string -> SnapshotWriter for its file
+        self.last_used = {} # server ID string -> time.monotonic() when it was last used
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, guild_id_str, extension=".snap"):
+        return os.path.join(self.directory, f"{guild_id_str}{extension}")
+
+    def get(self, guild_id_str, default=None):
+        guild_stats = self.loaded.get(guild_id_str)
+        if guild_stats is None:
+            from stats import GuildStats
+
+            converted = False
+            try:
+                guild_stats = GuildStats.load(self.path(guild_id_str))
+            except FileNotFoundError:
+                try:
+                    with open(self.path(guild_id_str, ".json")) as f:
+                        guild_stats = GuildStats.from_json(int(guild_id_str), json.load(f))
+                except FileNotFoundError:
+                    return default
+                converted = True
+
+            self.loaded[guild_id_str] = guild_stats
+            self.writers[guild_id_str] = SnapshotWriter(guild_stats, self.path(guild_id_str), self.save_delay, name="scores")
+            if converted:
+                self.writers[guild_id_str].touch()
+
+        self.last_used[guild_id_str] = time.monotonic()
+        return guild_stats
+
+    def __getitem__(self, guild_id_str):
+        guild_stats = self.get(guild_id_str)
+        if guild_stats is None:
+            raise KeyError(guild_id_str)
+
+        return guild_stats
+
+    def __setitem__(self, guild_id_str, guild_stats):
+        # keep the same writer if there is one, so two writers never write the same file at once
+        writer = self.writers.get(guild_id_str)
+        if writer is None:
+            writer = self.writers[guild_id_str] = SnapshotWriter(guild_stats, self.path(guild_id_str), self.save_delay, name="scores")
+        writer.data = guild_stats
+
+        self.loaded[guild_id_str] = guild_stats
+        self.last_used[guild_id_str] = time.monotonic()
+        writer.touch()
+
+    def __contains__(self, guild_id_str):
+        return guild_id_str in self.loaded or any(os.path.exists(self.path(guild_id_str, extension)) for extension in (".snap", ".json"))
+
+    def __len__(self):
+        return len(self.keys())
+
+    # every server with scores, loaded or not
+    def keys(self):
+        return set(self.loaded) | {os.path.splitext(name)[0] for name in os.listdir(self.directory) if name.endswith((".snap", ".json"))}
+
+    # loads every server, so only for things that really need all of them (like moving them to the database)
+    def items(self):
+        for guild_id_str in self.keys():
+            yield guild_id_str, self[guild_id_str]
+
+    # call after changing a server's scores
+    def touch(self, guild_id_str):
+        self.writers[guild_id_str].touch()
+
+    # write out and forget servers that haven't been used in the last `idle_time` seconds. returns the IDs
+    # of the servers that were dropped
+    async def evict_idle(self, idle_time):
+        cutoff = time.monotonic() - idle_time
+        evicted = []
+
+        for guild_id_str in [guild_id_str for guild_id_str, used in self.last_used.items() if used < cutoff]:
+            writer = self.writers[guild_id_str]
+            await writer.flush()
+
+            # it may have been used again while it was being written
+            if self.last_used[guild_id_str] >= cutoff or writer.dirty:
+                continue
+
+            if writer.task is not None:
+                writer.task.cancel()
+
+            del self.loaded[guild_id_str], self.writers[guild_id_str], self.last_used[guild_id_str]
+            evicted.append(guild_id_str)
+
+        return evicted
+
+    async def flush(self):
+        for writer in list(self.writers.values()):
+            await writer.flush()
+
+
+# the original storage, in files. open posts and preferences are kept in memory as dictionaries and saved
+# as JSON; each server's scores are a GuildStats (see stats.py) in their own snapshot file (see
+# GuildShards), loaded when they're first needed. scores can still be brought in and out in the JSON format
+# below, which is also what they were saved as before
+class JsonStore:
+    def __init__(self, scores_path="scores.json", open_posts_path="current_posts.json",
+                 preferences_path="preferences.json", scores_dir="scores", save_delay=5):
+        # the first time round, split the old single scores file into a file per server. it's split into
+        # another directory that's renamed into place once it's done, so if the bot stops partway through
+        # it's split again next time rather than losing the servers it hadn't got to
+        if not os.path.isdir(scores_dir) and os.path.exists(scores_path):
+            partial_dir = scores_dir + ".partial"
+            os.makedirs(partial_dir, exist_ok=True)
+            with open(scores_path) as scores:
+                for guild_id_str, guild_scores in json.load(scores).items():
+                    with open(os.path.join(partial_dir, f"{guild_id_str}.json"), "w") as f:
+                        json.dump(guild_scores, f, separators=(',', ':'))
+            os.replace(partial_dir, scores_dir)
+
+        self.scores = GuildShards(scores_dir, save_delay)
+
+        with open(preferences_path) as preferences, open(open_posts_path) as open_posts:
+            self.open_posts  = json.load(open_posts)
+            self.preferences = json.load(preferences)
+
+            # UPDATED JSON FORMAT: scores[str(message.guild.id)]["leaderboard" or "graph" or "submitted" or "records"]
+            # ["leaderboard"][str(message.author.id)]["score" or "submitted"]
+            # ["graph"][str(message.author.id)] is a list of tuples (individual image score, image # (for the server), time posted)
+            #   (posts from before times were recorded only have the first two)
+            # ["submitted"] is the # images submitted to the server
+            # ["records"]["best or words"] - each is a triple (message id, channel id, score)
+            # ["distribution"] and ["leaderboard"][str(message.author.id)]["distribution"] are {str(image score): # posts with that score}
+            #   for the whole server and for each user. they're rebuilt from ["graph"] if missing
+            # ["ledger"][str(image #)] is [message id, channel id, {emoji: # votes}] for each post whose votes were recorded
+
+        self.rankings = {} # server ID -> RankIndex, built the first time each server's leaderboard is needed
+        self.histories = {} # server ID -> ScoreHistory, built the first time each server's graph is needed
+        self.windows = {} # server ID -> WindowedScores, built the first time a leaderboard for part of its history is needed
+
+        self.open_posts_writer  = JsonWriter(self.open_posts, open_posts_path, save_delay)
+        self.preferences_writer = JsonWriter(self.preferences, preferences_path, save_delay)
+
+    # open posts: message ID string -> [channel ID, finish time, server ID] (posts saved before the server
+    # was recorded only have the first two)
+    def add_open_post(self, message_id, channel_id, finish_time, guild_id):
+        self.open_posts[str(message_id)] = [channel_id, finish_time, guild_id]
+        self.open_posts_writer.touch()
+
+    # returns whether the post was still open
+    def remove_open_post(self, message_id):
+        removed = self.open_posts.pop(str(message_id), None) is not None
+        self.open_posts_writer.touch()
+        return removed
+
+    # call after changing one server's preferences
+    def save_preferences(self, guild_id):
+        self.preferences_writer.touch()
+
+    # add a finished post to its server's scores and return its post number. `votes` is {emoji: number of
+    # votes} on the post, kept so it can be scored again if the server's key changes
+    def record_post(self, guild_id, author_id, message_id, channel_id, score, votes=None):
+        guild_stats = self.scores.get(str(guild_id))
+        if guild_stats is None:
+            from stats import GuildStats
+
+            guild_stats = self.scores[str(guild_id)] = GuildStats.new(int(guild_id))
+
+        posted = snowflake_time(message_id)
+        post_num = guild_stats.add_post(int(author_id), int(message_id), int(channel_id), score, posted, votes)
+
+        ranking = self.rankings.get(int(guild_id))
+        if ranking is not None:
+            ranking.add_post(int(author_id), score)
+
+        history = self.histories.get(int(guild_id))
+        if history is not None:
+            history.append(int(author_id), score, post_num, posted)
+
+        windowed = self.windows.get(int(guild_id))
+        if windowed is not None:
+            windowed.add_post(int(author_id), score, posted)
+
+        self.scores.touch(str(guild_id))
+        return post_num
+
+    # the server's RankIndex, or None if it has no scores
+    def ranking(self, guild_id):
+        ranking = self.rankings.get(int(guild_id))
+        if ranking is None:
+            guild_stats = self.scores.get(str(guild_id))
+            if guild_stats is None:
+                return None
+
+            ranking = self.rankings[int(guild_id)] = RankIndex(guild_stats.totals())
+
+        return ranking
+
+    # the server's best and worst posts, or None if it has none yet
+    def records(self, guild_id):
+        guild_stats = self.scores.get(str(guild_id))
+        if guild_stats is None or guild_stats.records is None:
+            return None
+
+        return dict(guild_stats.records)
+
+    def set_records(self, guild_id, records):
+        self.scores[str(guild_id)].records = {name: tuple(record) for name, record in records.items()}
+        self.scores.touch(str(guild_id))
+
+    # the server's ScoreHistory, or None if it has no scores
+    def history(self, guild_id):
+        history = self.histories.get(int(guild_id))
+        if history is None:
+            guild_stats = self.scores.get(str(guild_id))
+            if guild_stats is None:
+                return None
+
+            history = self.histories[int(guild_id)] = guild_stats.history()
+
+        return history
+
+    # the server's WindowedScores, or None if it has no scores
+    def windowed(self, guild_id):
+        windowed = self.windows.get(int(guild_id))
+        if windowed is None:
+            history = self.history(guild_id)
+            if history is None:
+                return None
+
+            from windows import WindowedScores
+
+            windowed = self.windows[int(guild_id)] = WindowedScores.from_history(history)
+
+        return windowed
+
+    # {image score: number of posts with that score}, for the whole server or just one user
+    def distribution(self, guild_id, user_id=None):
+        guild_stats = self.scores.get(str(guild_id))
+        if guild_stats is None:
+            return {}
+
+        if user_id is None:
+            return dict(guild_stats.distribution)
+
+        user = guild_stats.users.get(int(user_id))
+        return dict(user.distribution) if user is not None else {}
+
+    # count up the server's score distributions again from its posts
+    def rebuild_distributions(self, guild_id):
+        self.scores[str(guild_id)].rebuild_distributions()
+        self.scores.touch(str(guild_id))
+
+    # score every post in the server's ledger again under `key`, and rebuild the leaderboard, records,
+    # graph info and distributions to match. posts from before votes were recorded keep their scores.
+    # returns how many posts were scored again
+    def rescore(self, guild_id, key):
+        guild_stats = self.scores.get(str(guild_id))
+        if guild_stats is None:
+            return 0
+
+        rescored = guild_stats.rescore(key)
+        if rescored:
+            self.rankings.pop(int(guild_id), None)
+            self.windows.pop(int(guild_id), None)
+            self.histories.pop(int(guild_id), None)
+            self.scores.touch(str(guild_id))
+
+        return rescored
+
+    # swap in a whole server's scores at once, in the JSON format above
+    def replace_guild(self, guild_id, guild_scores):
+        from stats import GuildStats
+
+        self.scores[str(guild_id)] = GuildStats.from_json(int(guild_id), guild_scores)
+        self.rankings.pop(int(guild_id), None)
+        self.windows.pop(int(guild_id), None)
+        self.histories.pop(int(guild_id), None)
+
+    # every server's scores in the JSON format above, e.g. for moving them to the database. this loads
+    # every server, so it's slow with lots of them
+    def export_guilds(self):
+        for guild_id_str, guild_stats in self.scores.items():
+            yield guild_id_str, guild_stats.to_json()
+
+    # the server's finished posts in lists of up to `chunk_size` rows of (post number, user ID, score,
+    # time posted, message ID, channel ID, votes as JSON), with None for anything unknown. each chunk is
+    # read straight from the columns, so only one chunk is ever copied out at a time
+    def export_posts(self, guild_id, chunk_size=10000):
+        guild_stats = self.scores.get(str(guild_id))
+        if guild_stats is None:
+            return
+
+        size = guild_stats.size
+        for start in range(0, size, chunk_size):
+            end = min(start + chunk_size, size)
+            columns = [getattr(guild_stats, name)[start:end].tolist() for name in ("post_nums", "user_ids", "scores", "times", "message_ids", "channel_ids", "voted")]
+            votes = guild_stats.votes[start:end].tolist()
+
+            yield [(post_num, user_id, score, posted or None, message_id or None, channel_id or None,
+                    json.dumps({emoji: count for emoji, count in zip(guild_stats.emojis, counts) if count}) if voted else None)
+                   for post_num, user_id, score, posted, message_id, channel_id, voted, counts in zip(*columns, votes)]
+
+    # the server's users in lists of up to `chunk_size` rows of (user ID, score, posts)
+    def export_users(self, guild_id, chunk_size=10000):
+        guild_stats = self.scores.get(str(guild_id))
+        if guild_stats is None:
+            return
+
+        totals = list(guild_stats.totals())
+        for start in range(0, len(totals), chunk_size):
+            yield totals[start:start + chunk_size]
+
+    # drop servers that haven't been used for `idle_time` seconds from memory, with everything built from them
+    async def evict_idle(self, idle_time):
+        for guild_id_str in await self.scores.evict_idle(idle_time):
+            self.rankings.pop(int(guild_id_str), None)
+            self.windows.pop(int(guild_id_str), None)
+            self.histories.pop(int(guild_id_str), None)
+
+    # write out any pending changes straight away
+    async def flush(self):
+        await self.scores.flush()
+        for writer in (self.open_posts_writer, self.preferences_writer):
+            await writer.flush()
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS guilds (
+    guild_id         INTEGER PRIMARY KEY,
+    submitted        INTEGER NOT NULL,
+    best_message_id  INTEGER NOT NULL,
+    best_channel_id  INTEGER NOT NULL,
+    best_score       INTEGER NOT NULL,
+    worst_message_id INTEGER NOT NULL,
+    worst_channel_id INTEGER NOT NULL,
+    worst_score      INTEGER NOT NULL
+);
+
+-- one row per finished post. posts imported from JSON have no message or channel ID, and posts from
+-- before times were recorded were posted at time 0. votes is {emoji: number of votes} as JSON, or NULL
+-- for posts from before votes were recorded
+CREATE TABLE IF NOT EXISTS posts (
+    guild_id   INTEGER NOT NULL,
+    post_num   INTEGER NOT NULL,
+    user_id    INTEGER NOT NULL,
+    score      INTEGER NOT NULL,
+    message_id INTEGER,
+    channel_id INTEGER,
+    posted     REAL NOT NULL DEFAULT 0,
+    votes      TEXT,
+    PRIMARY KEY (guild_id, post_num)
+);
+CREATE INDEX IF NOT EXISTS posts_by_user ON posts (guild_id, user_id, post_num);
+CREATE INDEX IF NOT EXISTS posts_by_score ON posts (guild_id, score);
+
+-- per-user totals, kept up to date as posts finish
+CREATE TABLE IF NOT EXISTS users (
+    guild_id  INTEGER NOT NULL,
+    user_id   INTEGER NOT NULL,
+    score     INTEGER NOT NULL,
+    submitted INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS users_by_score ON users (guild_id, score);
+
+-- guild_id is NULL for posts saved before the server was recorded
+CREATE TABLE IF NOT EXISTS open_posts (
+    message_id  INTEGER PRIMARY KEY,
+    channel_id  INTEGER NOT NULL,
+    finish_time REAL NOT NULL,
+    guild_id    INTEGER
+);
+CREATE INDEX IF NOT EXISTS open_posts_by_expiry ON open_posts (finish_time);
+
+-- how many posts got each score, for each user and (with user ID 0) for the whole server
+CREATE TABLE IF NOT EXISTS score_counts (
+    guild_id INTEGER NOT NULL,
+    user_id  INTEGER NOT NULL,
+    score    INTEGER NOT NULL,
+    posts    INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, user_id, score)
+);
+
+-- one row per server per preference category, with the value stored as JSON
+CREATE TABLE IF NOT EXISTS settings (
+    guild_id INTEGER NOT NULL,
+    name     TEXT NOT NULL,
+    value    TEXT NOT NULL,
+    PRIMARY KEY (guild_id, name)
+);
+"""
+
+
+# stores everything in an SQLite database instead. only the open posts and preferences are kept in
+# memory; scores are read and updated a row at a time, so memory use and the cost of each write
+# depend on how much is going on rather than on how long the server's history is. several bot
+# processes can share one database (see the sharding settings in client.py), as long as each server's
+# posts and settings are only changed by the process running that server's shard
+class SqliteStore:
+    def __init__(self, database_path="james.db"):
+        # wait for other processes' writes rather than failing straight away, and use write-ahead logging
+        # so they don't block each other's reads
+        self.db = sqlite3.connect(database_path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SQLITE_SCHEMA)
+
+        # databases made before post times, votes or open posts' servers were recorded need the columns adding
+        for table, column, definition in (("posts", "posted", "REAL NOT NULL DEFAULT 0"), ("posts", "votes", "TEXT"),
+                                          ("open_posts", "guild_id", "INTEGER")):
+            if column not in [info[1] for info in self.db.execute(f"PRAGMA table_info({table})")]:
+                try:
+                    with self.db:
+                        self.db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+                except sqlite3.OperationalError:
+                    pass # another process starting at the same time got there first
+
+        # and databases made before score counts were kept need them counting up
+        if self.db.execute("SELECT 1 FROM posts").fetchone() and not self.db.execute("SELECT 1 FROM score_counts").fetchone():
+            for (guild_id,) in self.db.execute("SELECT guild_id FROM guilds").fetchall():
+                self.rebuild_distributions(guild_id)
+
+        self.open_posts = {}
+        self.preferences = {category: {} for category in PREFERENCE_CATEGORIES}
+        self.rankings = {} # server ID -> RankIndex, built the first time each server's leaderboard is needed
+        self.windows = {} # server ID -> WindowedScores, built the first time a leaderboard for part of its history is needed
+        self.last_used = {} # server ID -> time.monotonic() when its RankIndex or WindowedScores was last used
+        self.load_memory()
+
+    # (re)load the open posts and preferences from the database into the dictionaries in place, so
+    # anything holding a reference to them sees the new contents
+    def load_memory(self):
+        self.open_posts.clear()
+        for message_id, channel_id, finish_time, guild_id in self.db.execute("SELECT message_id, channel_id, finish_time, guild_id FROM open_posts"):
+            self.open_posts[str(message_id)] = [channel_id, finish_time] if guild_id is None else [channel_id, finish_time, guild_id]
+
+        for values in self.preferences.values():
+            values.clear()
+        for guild_id, name, value in self.db.execute("SELECT guild_id, name, value FROM settings"):
+            self.preferences.setdefault(name, {})[str(guild_id)] = json.loads(value)
+
+    def add_open_post(self, message_id, channel_id, finish_time, guild_id):
+        self.open_posts[str(message_id)] = [channel_id, finish_time, guild_id]
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO open_posts VALUES (?, ?, ?, ?)", (int(message_id), channel_id, finish_time, guild_id))
+
+    # returns whether the post was still open. this goes by the database rather than memory, so when
+    # processes share the database only one of them can ever finish a post
+    def remove_open_post(self, message_id):
+        self.open_posts.pop(str(message_id), None)
+        with self.db:
+            return self.db.execute("DELETE FROM open_posts WHERE message_id = ?", (int(message_id),)).rowcount > 0
+
+    def save_preferences(self, guild_id):
+        guild_id_str = str(guild_id)
+        with self.db:
+            for name, values in self.preferences.items():
+                if guild_id_str in values:
+                    self.db.execute("INSERT OR REPLACE INTO settings VALUES (?, ?, ?)", (int(guild_id), name, json.dumps(values[guild_id_str])))
+                else:
+                    self.db.execute("DELETE FROM settings WHERE guild_id = ? AND name = ?", (int(guild_id), name))
+
+    def record_post(self, guild_id, author_id, message_id, channel_id, score, votes=None):
+        with registry.timer("james_save_seconds", file="database"), self.db:
+            row = self.db.execute("SELECT submitted, best_score, worst_score FROM guilds WHERE guild_id = ?", (guild_id,)).fetchone()
+            if row is None:
+                self.insert_guild_row(guild_id, 0, new_records())
+                row = (0, new_records()["best"][2], new_records()["worst"][2])
+
+            submitted, best_score, worst_score = row
+            post_num = submitted + 1
+
+            self.db.execute("INSERT INTO posts (guild_id, post_num, user_id, score, message_id, channel_id, posted, votes) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (guild_id, post_num, author_id, score, message_id, channel_id, snowflake_time(message_id),
+                             json.dumps(votes) if votes else None))
+            self.db.execute("""INSERT INTO users VALUES (?, ?, ?, 1)
+                               ON CONFLICT (guild_id, user_id) DO UPDATE SET score = score + excluded.score, submitted = submitted + 1""",
+                            (guild_id, author_id, score))
+            self.db.execute("UPDATE guilds SET submitted = ? WHERE guild_id = ?", (post_num, guild_id))
+            self.db.executemany("""INSERT INTO score_counts VALUES (?, ?, ?, 1)
+                                   ON CONFLICT (guild_id, user_id, score) DO UPDATE SET posts = posts + 1""",
+                                ((guild_id, author_id, score), (guild_id, 0, score)))
+
+            if score < worst_score:
+                self.db.execute("UPDATE guilds SET worst_message_id = ?, worst_channel_id = ?, worst_score = ? WHERE guild_id = ?",
+                                (message_id, channel_id, score, guild_id))
+
+            if score > best_score:
+                self.db.execute("UPDATE guilds SET best_message_id = ?, best_channel_id = ?, best_score = ? WHERE guild_id = ?",
+                                (message_id, channel_id, score, guild_id))
+
+        ranking = self.rankings.get(guild_id)
+        if ranking is not None:
+            ranking.add_post(author_id, score)
+
+        windowed = self.windows.get(guild_id)
+        if windowed is not None:
+            windowed.add_post(author_id, score, snowflake_time(message_id))
+
+        return post_num
+
+    def ranking(self, guild_id):
+        self.last_used[guild_id] = time.monotonic()
+        ranking = self.rankings.get(guild_id)
+        if ranking is None:
+            totals = self.db.execute("SELECT user_id, score, submitted FROM users WHERE guild_id = ?", (guild_id,)).fetchall()
+            if not totals:
+                return None
+
+            ranking = self.rankings[guild_id] = RankIndex(totals)
+
+        return ranking
+
+    def records(self, guild_id):
+        row = self.db.execute("""SELECT best_message_id, best_channel_id, best_score, worst_message_id, worst_channel_id, worst_score
+                                 FROM guilds WHERE guild_id = ?""", (guild_id,)).fetchone()
+        if row is None:
+            return None
+
+        return {"best": row[:3], "worst": row[3:]}
+
+    def set_records(self, guild_id, records):
+        with self.db:
+            self.db.execute("""UPDATE guilds SET best_message_id = ?, best_channel_id = ?, best_score = ?,
+                               worst_message_id = ?, worst_channel_id = ?, worst_score = ? WHERE guild_id = ?""",
+                            (*records["best"], *records["worst"], guild_id))
+
+    def history(self, guild_id):
+        row = self.db.execute("SELECT submitted FROM guilds WHERE guild_id = ?", (guild_id,)).fetchone()
+        if row is None:
+            return None
+
+        import numpy as np
+        from history import ScoreHistory
+
+        posts = self.db.execute("SELECT user_id, score, post_num, posted FROM posts WHERE guild_id = ?", (guild_id,)).fetchall()
+        columns = np.array([post[:3] for post in posts], np.int64).reshape(-1, 3)
+        times = np.array([post[3] for post in posts], np.float64)
+
+        return ScoreHistory.from_columns(columns[:, 0], columns[:, 1], columns[:, 2], times, row[0])
+
+    def windowed(self, guild_id):
+        self.last_used[guild_id] = time.monotonic()
+        windowed = self.windows.get(guild_id)
+        if windowed is None:
+            history = self.history(guild_id)
+            if history is None:
+                return None
+
+            from windows import WindowedScores
+
+            windowed = self.windows[guild_id] = WindowedScores.from_history(history)
+
+        return windowed
+
+    def export_posts(self, guild_id, chunk_size=10000):
+        cursor = self.db.execute("SELECT post_num, user_id, score, posted, message_id, channel_id, votes FROM posts WHERE guild_id = ? ORDER BY post_num", (guild_id,))
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield [(*row[:3], row[3] or None, *row[4:]) for row in rows]
+
+    def export_users(self, guild_id, chunk_size=10000):
+        cursor = self.db.execute("SELECT user_id, score, submitted FROM users WHERE guild_id = ? ORDER BY user_id", (guild_id,))
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield rows
+
+    def distribution(self, guild_id, user_id=None):
+        rows = self.db.execute("SELECT score, posts FROM score_counts WHERE guild_id = ? AND user_id = ?", (guild_id, user_id or 0))
+        return dict(rows.fetchall())
+
+    def rebuild_distributions(self, guild_id):
+        with self.db:
+            self.count_scores(guild_id)
+
+    # recount a server's score_counts from its posts. this is part of whatever transaction the caller is
+    # in, so a failed import or rescore doesn't leave half its changes committed
+    def count_scores(self, guild_id):
+        self.db.execute("DELETE FROM score_counts WHERE guild_id = ?", (guild_id,))
+        self.db.execute("""INSERT INTO score_counts SELECT guild_id, user_id, score, COUNT(*) FROM posts
+                           WHERE guild_id = ? GROUP BY user_id, score""", (guild_id,))
+        self.db.execute("""INSERT INTO score_counts SELECT guild_id, 0, score, COUNT(*) FROM posts
+                           WHERE guild_id = ? GROUP BY score""", (guild_id,))
+
+    def rescore(self, guild_id, key):
+        rows = self.db.execute("SELECT post_num, message_id, channel_id, votes FROM posts WHERE guild_id = ? AND votes IS NOT NULL ORDER BY post_num",
+                               (guild_id,)).fetchall()
+        if not rows:
+            return 0
+
+        import numpy as np
+        from ledger import VoteLedger, post_records
+
+        ledger = VoteLedger.from_rows((post_num, message_id, channel_id, json.loads(votes)) for post_num, message_id, channel_id, votes in rows)
+        scores = ledger.scores(key)
+
+        with self.db:
+            self.db.executemany("UPDATE posts SET score = ? WHERE guild_id = ? AND post_num = ?",
+                                ((score, guild_id, post_num) for score, post_num in zip(scores.tolist(), ledger.post_nums.tolist())))
+            self.db.execute("""UPDATE users SET score = (SELECT SUM(score) FROM posts WHERE posts.guild_id = users.guild_id AND posts.user_id = users.user_id)
+                               WHERE guild_id = ?""", (guild_id,))
+            self.count_scores(guild_id)
+
+            # the records are over every post, including ones from before votes were kept
+            posts = np.array(self.db.execute("SELECT score, COALESCE(message_id, 0), COALESCE(channel_id, 0) FROM posts WHERE guild_id = ?",
+                                             (guild_id,)).fetchall(), np.int64).reshape(-1, 3)
+            records = post_records(posts[:, 0], posts[:, 1], posts[:, 2], self.records(guild_id))
+
+        self.set_records(guild_id, records)
+        self.rankings.pop(guild_id, None)
+        self.windows.pop(guild_id, None)
+        return len(ledger)
+
+    def replace_guild(self, guild_id, guild_scores):
+        with self.db:
+            self.delete_guild(guild_id)
+            self.insert_guild(guild_id, guild_scores)
+
+    # copy everything from another store (e.g. the old JSON files) into the database, replacing any
+    # servers it already has
+    def import_store(self, source):
+        with self.db:
+            for guild_id_str, guild_scores in source.export_guilds():
+                self.delete_guild(int(guild_id_str))
+                self.insert_guild(int(guild_id_str), guild_scores)
+
+            self.db.executemany("INSERT OR REPLACE INTO open_posts VALUES (?, ?, ?, ?)",
+                                ((int(message_id), post[0], post[1], post[2] if len(post) > 2 else None) for message_id, post in source.open_posts.items()))
+
+            self.db.executemany("INSERT OR REPLACE INTO settings VALUES (?, ?, ?)",
+                                ((int(guild_id_str), name, json.dumps(value)) for name, values in source.preferences.items()
+                                 for guild_id_str, value in values.items()))
+
+        self.load_memory()
+
+    def delete_guild(self, guild_id):
+        self.rankings.pop(guild_id, None)
+        self.windows.pop(guild_id, None)
+        for table in ("guilds", "posts", "users", "score_counts"):
+            self.db.execute(f"DELETE FROM {table} WHERE guild_id = ?", (guild_id,))
+
+    def insert_guild_row(self, guild_id, submitted, records):
+        self.db.execute("INSERT INTO guilds VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (guild_id, submitted, *records["best"], *records["worst"]))
+
+    # insert a server's scores given in the JSON format
+    def insert_guild(self, guild_id, guild_scores):
+        self.insert_guild_row(guild_id, guild_scores["submitted"], guild_scores.get("records") or new_records())
+
+        self.db.executemany("INSERT INTO users VALUES (?, ?, ?, ?)",
+                            ((guild_id, int(user_id), info["score"], info["submitted"]) for user_id, info in guild_scores["leaderboard"].items()))
+
+        self.db.executemany("INSERT OR REPLACE INTO posts (guild_id, post_num, user_id, score, posted) VALUES (?, ?, ?, ?, ?)",
+                            ((guild_id, post[1], int(user_id), post[0], post[2] if len(post) > 2 else 0)
+                             for user_id, posts in guild_scores["graph"].items() for post in posts))
+
+        self.db.executemany("UPDATE posts SET message_id = ?, channel_id = ?, votes = ? WHERE guild_id = ? AND post_num = ?",
+                            ((message_id, channel_id, json.dumps(votes), guild_id, int(post_num))
+                             for post_num, (message_id, channel_id, votes) in guild_scores.get("ledger", {}).items()))
+
+        self.count_scores(guild_id)
+
+    # the scores themselves stay in the database, so only the cached leaderboards need dropping
+    async def evict_idle(self, idle_time):
+        cutoff = time.monotonic() - idle_time
+        for guild_id in [guild_id for guild_id, used in self.last_used.items() if used < cutoff]:
+            self.rankings.pop(guild_id, None)
+            self.windows.pop(guild_id, None)
+            del self.last_used[guild_id]
+
+    # every change is committed as it happens, so there is never anything waiting to be written
+    async def flush(self):
+        pass
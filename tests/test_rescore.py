@@ -0,0 +1,63 @@
+import asyncio
+import json
+
+import pytest
+
+from storage import PREFERENCE_CATEGORIES, JsonStore, SqliteStore
+
+GUILD_ID = 5
+
+# a server from before votes were kept: posts scoring 2, -1 and 3, with records for the last two
+LEGACY_SCORES = {"submitted": 3,
+                 "leaderboard": {"1": {"score": 5, "submitted": 2}, "2": {"score": -1, "submitted": 1}},
+                 "graph": {"1": [[2, 1, 1e9], [3, 3, 1e9 + 2]], "2": [[-1, 2, 1e9 + 1]]},
+                 "records": {"best": [103, 9, 3], "worst": [102, 9, -1]}}
+
+
+def make_store(kind, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    if kind == "sqlite":
+        return SqliteStore(str(tmp_path / "james.db"))
+
+    with open("preferences.json", "w") as f:
+        json.dump({category: {} for category in PREFERENCE_CATEGORIES}, f)
+    with open("current_posts.json", "w") as f:
+        json.dump({}, f)
+    return JsonStore()
+
+
+# a post that held a record and is rescored past older posts has to give the record up to them
+@pytest.mark.parametrize("kind", ["json", "sqlite"])
+def test_rescore_records_include_posts_without_votes(kind, tmp_path, monkeypatch):
+    async def run():
+        store = make_store(kind, tmp_path, monkeypatch)
+        store.replace_guild(GUILD_ID, LEGACY_SCORES)
+        store.record_post(GUILD_ID, 2, 200, 9, 10, {"👍": 10})
+        assert store.records(GUILD_ID)["best"][2] == 10
+
+        assert store.rescore(GUILD_ID, {"👍": -1}) == 1
+        records = store.records(GUILD_ID)
+        assert tuple(records["worst"]) == (200, 9, -10)
+        assert records["best"][2] == 3
+        if kind == "sqlite":
+            store.db.close()
+
+    asyncio.run(run())
+
+
+# when nothing beats it, an old record keeps its message even though its post has no message ID
+@pytest.mark.parametrize("kind", ["json", "sqlite"])
+def test_rescore_keeps_old_records_for_posts_without_votes(kind, tmp_path, monkeypatch):
+    async def run():
+        store = make_store(kind, tmp_path, monkeypatch)
+        store.replace_guild(GUILD_ID, LEGACY_SCORES)
+        store.record_post(GUILD_ID, 2, 200, 9, 1, {"👍": 1})
+
+        store.rescore(GUILD_ID, {"👍": 2})
+        records = store.records(GUILD_ID)
+        assert tuple(records["best"]) == (103, 9, 3)
+        assert tuple(records["worst"]) == (102, 9, -1)
+        if kind == "sqlite":
+            store.db.close()
+
+    asyncio.run(run())
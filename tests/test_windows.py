@@ -0,0 +1,70 @@
+import random
+import time
+
+import numpy as np
+
+from history import ScoreHistory
+from windows import DAY, WindowedScores
+
+
+# {user id: (score, posts)} for posts made in [since, until), worked out one post at a time
+def brute_force(history, since, until):
+    totals = {}
+    for user_index, score, posted in zip(history.user_idx[:history.size].tolist(), history.scores[:history.size].tolist(),
+                                         history.times[:history.size].tolist()):
+        if since is not None and (posted <= 0 or posted < since):
+            continue
+        if until is not None and posted >= until:
+            continue
+        user_score, user_posts = totals.get(history.users[user_index], (0, 0))
+        totals[history.users[user_index]] = (user_score + score, user_posts + 1)
+    return totals
+
+
+def random_history(rng, posts, now):
+    start = now - rng.uniform(10, 400) * DAY
+    times = np.array([0.0 if rng.random() < 0.05 else rng.uniform(start, now) for _ in range(posts)])
+    return ScoreHistory.from_columns(np.array([rng.randint(1, 8) for _ in range(posts)], np.int64),
+                                     np.array([rng.randint(-3, 5) for _ in range(posts)], np.int64),
+                                     np.arange(1, posts + 1, dtype=np.int64), times, posts)
+
+
+def check_windows(rng, windowed, history, now):
+    times = history.times[:history.size]
+    first = times[times > 0].min() if (times > 0).any() else now
+    for _ in range(50):
+        since = rng.choice([None, rng.uniform(first - 30*DAY, now)])
+        until = rng.choice([None, rng.uniform(since or first - 30*DAY, now + DAY)])
+        ranking, used_since, used_until = windowed.window(since, until)
+
+        # the window can be stretched to the nearest edges (or left open), but never shrunk
+        assert since is None or used_since <= since
+        assert used_until is None or (until is not None and used_until >= until)
+
+        got = {user_id: (score, posts) for user_id, score, posts in ranking.page(1, len(ranking))}
+        assert got == brute_force(history, used_since, used_until)
+
+
+def test_window_matches_brute_force():
+    rng = random.Random(1)
+    now = time.time()
+    for _ in range(20):
+        history = random_history(rng, rng.randint(1, 300), now)
+        check_windows(rng, WindowedScores.from_history(history), history, now)
+
+
+# posts counted as they finish, not always in the order they were made
+def test_window_matches_brute_force_after_adding_posts():
+    rng = random.Random(2)
+    now = time.time()
+    for _ in range(20):
+        history = random_history(rng, rng.randint(2, 300), now)
+        built = rng.randint(0, history.size - 1)
+
+        windowed = WindowedScores.from_history(ScoreHistory.from_columns(
+            np.array([history.users[index] for index in history.user_idx[:built]], np.int64),
+            history.scores[:built], history.post_nums[:built], history.times[:built], built))
+        for index in range(built, history.size):
+            windowed.add_post(history.users[history.user_idx[index]], int(history.scores[index]), float(history.times[index]))
+
+        check_windows(rng, windowed, history, now)
@@ -0,0 +1,142 @@
+from datetime import datetime, timezone
+
+import numpy as np
+
+from ranking import RankIndex
+
+DAY = 24*60*60
+
+
+# a server's scores split up by when the posts were made, so the leaderboard for any stretch of time can
+# be worked out without going through the posts. time is cut into buckets at a list of edges, and for
+# each user and edge this keeps the score and number of posts from before that edge (prefix sums), so
+# the totals between two edges are a subtraction. recent time has an edge every day, older time every
+# week (on Mondays) and the oldest every month. as days age, the edges between them are dropped, which
+# merges their buckets without anything having to be added up again. dropped edges are gone for good,
+# so the weekly stretch keeps the 1st of each month too, for when it becomes monthly. the start of the
+# day of the earliest post is always kept as an edge, so nothing is ever between the first two edges
+class WindowedScores:
+    def __init__(self, daily_days=35, weekly_days=26*7):
+        self.daily_days = daily_days # days that keep their own bucket
+        self.weekly_days = weekly_days # days before the rest are merged into months
+        self.users = [] # user index -> user id
+        self.user_index = {} # user id -> user index
+        self.edges = np.zeros(0, np.float64) # unix times, in order
+        self.scores = np.zeros((0, 0), np.int64) # users x edges: score from posts before each edge
+        self.posts = np.zeros((0, 0), np.int64) # users x edges: posts before each edge
+        self.total_scores = np.zeros(0, np.int64) # users: every post, including ones after the last edge
+        self.total_posts = np.zeros(0, np.int64)
+        self.today = None # start of the day the edges were last brought up to
+
+    # build from a ScoreHistory
+    @classmethod
+    def from_history(cls, history, now=None, **kwargs):
+        windowed = cls(**kwargs)
+        users, user_idx = history.users, history.user_idx[:history.size]
+        scores, times = history.scores[:history.size], history.times[:history.size]
+
+        windowed.users = list(users)
+        windowed.user_index = {user_id: index for index, user_id in enumerate(users)}
+        windowed.total_scores = np.bincount(user_idx, weights=scores, minlength=len(users)).astype(np.int64)
+        windowed.total_posts = np.bincount(user_idx, minlength=len(users)).astype(np.int64)
+
+        # the first edge is there to keep posts with no time (0) out of every window
+        known = times[times > 0]
+        windowed.today = (now or datetime.now(timezone.utc).timestamp()) // DAY * DAY
+        first_day = min(known.min() // DAY * DAY, windowed.today) if len(known) else windowed.today
+        windowed.edges = np.array([1, first_day] + [edge for edge in np.arange(first_day + DAY, windowed.today + DAY, DAY)
+                                                    if windowed.keep_edge(edge)], np.float64)
+
+        # count each post in the bucket it falls in, then add the buckets up
+        num_users, num_edges = len(users), len(windowed.edges)
+        buckets = np.searchsorted(windowed.edges, times, "right")
+        for name, weights in (("scores", scores), ("posts", np.ones(len(scores), np.int64))):
+            counts = np.zeros((num_users, num_edges + 1), np.int64)
+            np.add.at(counts, (user_idx, buckets), weights)
+            setattr(windowed, name, np.cumsum(counts, axis=1)[:, :num_edges])
+
+        return windowed
+
+    # whether a day's start (a unix time) still gets its own edge
+    def keep_edge(self, edge):
+        age = (self.today - edge) / DAY
+        if age < self.daily_days:
+            return True
+
+        day = datetime.fromtimestamp(edge, timezone.utc)
+        if age < self.weekly_days:
+            return day.weekday() == 0 or day.day == 1
+        return day.day == 1
+
+    # add an edge for each day started since the last call, and drop the ones that have aged out
+    def advance(self, now=None):
+        today = (now or datetime.now(timezone.utc).timestamp()) // DAY * DAY
+        if today <= self.today:
+            return
+
+        new_edges = np.arange(self.today + DAY, today + DAY, DAY)
+        self.today = today
+
+        # nothing has been posted after the new edges yet, so each user's totals are already what's before them
+        self.edges = np.r_[self.edges, new_edges]
+        self.scores = np.c_[self.scores, np.repeat(self.total_scores[:, None], len(new_edges), axis=1)]
+        self.posts = np.c_[self.posts, np.repeat(self.total_posts[:, None], len(new_edges), axis=1)]
+
+        keep = np.array([True, True] + [self.keep_edge(edge) for edge in self.edges[2:]], bool)
+        self.edges, self.scores, self.posts = self.edges[keep], self.scores[:, keep], self.posts[:, keep]
+
+    # count a finished post, made at `posted` (a unix time), towards its author's totals
+    def add_post(self, user_id, score, posted):
+        self.advance()
+
+        index = self.user_index.get(user_id)
+        if index is None:
+            index = self.user_index[user_id] = len(self.users)
+            self.users.append(user_id)
+            self.scores = np.r_[self.scores, np.zeros((1, len(self.edges)), np.int64)]
+            self.posts = np.r_[self.posts, np.zeros((1, len(self.edges)), np.int64)]
+            self.total_scores = np.r_[self.total_scores, 0]
+            self.total_posts = np.r_[self.total_posts, 0]
+
+        # a post from before the earliest post's day (e.g. one that finished after a later one) gets an
+        # edge for its own day. nothing was posted before the new edge, so it has the same totals as the first
+        if 0 < posted < self.edges[1]:
+            self.edges = np.insert(self.edges, 1, posted // DAY * DAY)
+            self.scores = np.insert(self.scores, 1, self.scores[:, 0], axis=1)
+            self.posts = np.insert(self.posts, 1, self.posts[:, 0], axis=1)
+
+        # the post is before every edge after its time
+        first = np.searchsorted(self.edges, posted, "right")
+        self.scores[index, first:] += score
+        self.posts[index, first:] += 1
+        self.total_scores[index] += score
+        self.total_posts[index] += 1
+
+    # totals from before edge number `position`, or from everything if it's past the last edge
+    def before(self, position):
+        if position >= len(self.edges):
+            return self.total_scores, self.total_posts
+        return self.scores[:, position], self.posts[:, position]
+
+    # (RankIndex of users who posted between the two unix times, start, end). the window is stretched out
+    # to the nearest edges, and the times it actually covers are returned (None for open ends)
+    def window(self, since=None, until=None):
+        self.advance()
+
+        # nothing is between the first two edges, so a window starting there doesn't need stretching
+        start = max(np.searchsorted(self.edges, since, "right") - 1, 0) if since is not None else 0
+        end = np.searchsorted(self.edges, until, "left") if until is not None else len(self.edges)
+        if since is None:
+            start_scores, start_posts = np.zeros_like(self.total_scores), np.zeros_like(self.total_posts)
+        else:
+            start_scores, start_posts = self.before(start)
+            if start > 0:
+                since = float(self.edges[start])
+
+        end_scores, end_posts = self.before(end)
+        until = float(self.edges[end]) if end < len(self.edges) else None
+
+        scores, posts = end_scores - start_scores, end_posts - start_posts
+        active = np.flatnonzero(posts > 0)
+        ranking = RankIndex((self.users[index], int(scores[index]), int(posts[index])) for index in active)
+        return ranking, since, until